@@ -0,0 +1,211 @@
+import pandas as pd
+import argparse
+import subprocess
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+'''
+A script to time and memory-profile every stage of the pipeline on
+synthetic cohorts of increasing size. Each stage is run as its own
+process, exactly as the experiment shell scripts run it, and its wall
+time, CPU time and peak resident memory are appended to a results file.
+
+Run Parameters
+--------------
+sizes : list of integers
+    The numbers of meal items of the synthetic cohorts to benchmark.
+stages : list of strings
+    The stages to run. Valid choices are the keys of STAGES, which are
+    all run by default. Stages depend on the outputs of earlier stages.
+workfolder : directory location
+    Location of the directory to generate the cohorts in. Cohorts that
+    already exist in it are reused. If absent, a temporary directory
+    is used and removed afterwards.
+excel : flag
+    If this flag is present, the meals are generated as meals.xlsx
+    rather than meals.csv, so that read_excel is benchmarked too.
+seed : integer
+    The random seed of the synthetic cohorts.
+results : file location
+    Location of the csv file the results are appended to.
+
+Report Parameters
+-----------------
+results : file location
+    Location of the csv file holding the results.
+revision : string
+    The revision to report on. Defaults to the most recent one.
+compare : string
+    A revision to compare against. If present, the ratio of the wall
+    times of the two revisions is reported instead.
+'''
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PREPROCESSING = os.path.join(ROOT, 'Preprocessing')
+EXPERIMENTS = os.path.join(ROOT, 'Experiments')
+EXPERIMENT = os.path.join(EXPERIMENTS, 'Raw', 'Key')
+
+'''
+The commands of each stage, given the data folder and the output folder of a cohort.
+'''
+STAGES = {'generate': lambda data, output, args:
+              [os.path.join(ROOT, 'Data', 'synthetic.py'), data, '-items', str(args.size), '-seed', str(args.seed)] +
+              ([] if args.excel else ['-csv']),
+          'preprocessing': lambda data, output, args:
+              [os.path.join(PREPROCESSING, 'global_preprocessing.py'), '-data', data],
+          'adc': lambda data, output, args:
+              [os.path.join(EXPERIMENTS, 'ADC', 'adc.py'), os.path.join(data, 'day_aggregation.csv'),
+               os.path.join(output, 'adc.csv')],
+          'rni': lambda data, output, args:
+              [os.path.join(EXPERIMENTS, 'RNI', 'rni.py'), os.path.join(data, 'day_aggregation.csv'),
+               os.path.join(output, 'rni.csv')],
+          'md': lambda data, output, args:
+              [os.path.join(EXPERIMENTS, 'MD', 'md.py'), os.path.join(data, 'day_aggregation.csv'),
+               os.path.join(output, 'md.csv')],
+          'kmeans': lambda data, output, args:
+              [os.path.join(EXPERIMENTS, 'cluster_analysis.py'), os.path.join(data, 'day_aggregation.csv'),
+               os.path.join(EXPERIMENT, 'input_columns.txt'), 'kmeans', '2', '-pca', '5',
+               '-loadings', os.path.join(output, 'pca_loadings.csv'),
+               '-export', 'cluster', os.path.join(output, 'pca_clusters.csv')],
+          'label': lambda data, output, args:
+              [os.path.join(EXPERIMENTS, 'label.py'), os.path.join(data, 'day_aggregation.csv'),
+               os.path.join(output, 'pca_clusters.csv'), 'cluster', os.path.join(output, 'raw_clusters.csv'), 'cluster'],
+          'plot': lambda data, output, args:
+              [os.path.join(EXPERIMENTS, 'plot.py'), os.path.join(output, 'raw_clusters.csv'),
+               '-bar_columns', os.path.join(EXPERIMENT, 'bar_columns.txt'),
+               '-box_columns', os.path.join(EXPERIMENT, 'box_columns.txt'),
+               '-cluster_column', 'cluster', os.path.join(output, 'plots')]}
+
+def main():
+    directory = os.path.dirname(__file__)
+
+    parser = argparse.ArgumentParser()
+
+    sp = parser.add_subparsers()
+
+    run_parser = sp.add_parser('run', help = 'Run the benchmarks')
+    run_parser.add_argument('-sizes', help = 'Numbers of meal items', type = int, nargs = '+',
+                            default = [1000, 10000, 100000, 1000000])
+    run_parser.add_argument('-stages', help = 'Stages to run', nargs = '+', choices = list(STAGES),
+                            default = list(STAGES))
+    run_parser.add_argument('-workfolder', help = 'Folder to generate the cohorts in')
+    run_parser.add_argument('-excel', help = 'Generate meals.xlsx', action = 'store_true')
+    run_parser.add_argument('-seed', help = 'Random seed', type = int, default = 0)
+    run_parser.add_argument('-results', help = 'Results file', default = 'results.csv')
+    run_parser.set_defaults(func = run)
+
+    report_parser = sp.add_parser('report', help = 'Report the benchmark results')
+    report_parser.add_argument('-results', help = 'Results file', default = 'results.csv')
+    report_parser.add_argument('-revision', help = 'Revision to report')
+    report_parser.add_argument('-compare', help = 'Revision to compare against')
+    report_parser.set_defaults(func = report)
+
+    args = parser.parse_args()
+    args.func(args, directory)
+
+def run(args, directory):
+    workfolder = args.workfolder or tempfile.mkdtemp()
+    revision = git_revision()
+
+    try:
+        for size in args.sizes:
+            args.size = size
+            data = os.path.join(workfolder, '%d-%d' % (size, args.seed))
+            output = os.path.join(data, 'output')
+            os.makedirs(os.path.join(output, 'plots'), exist_ok = True)
+
+            for stage in args.stages:
+                if stage == 'generate' and os.path.exists(os.path.join(data, 'questionnaires.csv')):
+                    continue
+
+                result = measure(STAGES[stage](data, output, args), PREPROCESSING if stage == 'preprocessing' else directory)
+                result.update({'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': revision,
+                               'items': size, 'stage': stage})
+
+                print('%s (%d items): %.2fs wall, %.2fs cpu, %.1fMB peak' %
+                    (stage, size, result['wall'], result['cpu'], result['peak memory (MB)']))
+
+                save(result, os.path.join(directory, args.results))
+
+                # Later stages depend on the outputs of the failed stage
+                if result['status'] != 0:
+                    print('%s failed with status %d, skipping the remaining stages' % (stage, result['status']))
+                    break
+    finally:
+        if not args.workfolder:
+            shutil.rmtree(workfolder, ignore_errors = True)
+
+'''
+Runs a python script in a new process and measures it.
+
+Parameters
+----------
+command : list
+    The script and its arguments.
+cwd : string
+    The working directory of the process.
+
+Returns
+-------
+result : dictionary
+    The wall time and CPU time in seconds, the peak resident memory and
+    the exit status of the process.
+'''
+def measure(command, cwd):
+    start = time.perf_counter()
+
+    process = subprocess.Popen([sys.executable] + command, cwd = cwd,
+                               stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    # wait4 reports the resource usage of this process alone, rather than of all children
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return {'wall': time.perf_counter() - start,
+            'cpu': usage.ru_utime + usage.ru_stime,
+            'peak memory (MB)': usage.ru_maxrss/1024.0,
+            'status': process.returncode}
+
+def save(result, results_file):
+    columns = ['timestamp', 'revision', 'items', 'stage', 'wall', 'cpu', 'peak memory (MB)', 'status']
+    exists = os.path.exists(results_file)
+
+    pd.DataFrame([result])[columns].to_csv(results_file, mode = 'a', header = not exists, index = False)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT,
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+'''
+Prints the scaling curves of a revision, i.e. the wall time, CPU time and peak
+memory of every stage against the number of meal items, or the ratio of its
+wall times to those of another revision.
+'''
+def report(args, directory):
+    results = pd.read_csv(os.path.join(directory, args.results), dtype = {'revision': str})
+    results = results[results['status'] == 0]
+
+    revision = args.revision or results['revision'].iloc[-1]
+
+    # Only the most recent measurement of a stage and size is reported
+    def curves(revision):
+        return results[results['revision'] == revision].groupby(['stage', 'items']).last()
+
+    current = curves(revision)
+
+    if args.compare:
+        ratio = (current['wall']/curves(args.compare)['wall']).unstack('items')
+        print('Wall Time Ratio (%s/%s):\n%s\n' % (revision, args.compare, ratio.round(2).to_string()))
+        return
+
+    for c in ['wall', 'cpu', 'peak memory (MB)']:
+        print('%s (%s):\n%s\n' % (c, revision, current[c].unstack('items').round(2).to_string()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import pandas as pd
+import contextlib
+import sqlite3
+import os
+
+'''
+Notes
+-----
+This module contains the functions used to store the preprocessed data in
+a local SQLite database, and to read subsets of it (or of the csv, Parquet
+or Feather files) by subject and date. The format of a file is given by
+its extension.
+
+The tables written by global_preprocessing.py are indexed on their keys,
+e.g. (email, date) for day_aggregation and (email, date, foodtype) for
+meal_aggregation, so that looking up a subject or a range of dates does
+not read the whole table. Other tables are indexed on their email column,
+and on (email, date) if their date column holds dates.
+
+When the cache is enabled, e.g. by session.py, data files that have not
+changed since they were last read are not read again.
+'''
+
+DATABASE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+COLUMNAR_EXTENSIONS = ('.parquet', '.feather')
+
+# The columns that identify a row of each preprocessed table
+KEYS = {'day_aggregation': ['email', 'date'],
+        'rolling_aggregation': ['email', 'date'],
+        'meal_aggregation': ['email', 'date', 'foodtype'],
+        'meal_aggregation_solid': ['email', 'date', 'foodtype'],
+        'meal_aggregation_liquid': ['email', 'date', 'foodtype'],
+        'meal_cube': ['email', 'date', 'foodtype', 'kind'],
+        'week_aggregation': ['email', 'week'],
+        'subject_aggregation': ['email']}
+
+CACHE = None
+
+def enable_cache():
+    global CACHE
+    CACHE = {}
+
+'''
+Writes tables to a database, replacing any existing tables of the same name.
+
+Parameters
+----------
+database : file location
+    Location of the database. It is created if it does not exist.
+tables : dictionary
+    The dataframe to store under each table name.
+'''
+def write(database, tables):
+    # The inner with commits the transaction, and closing closes the connection
+    with contextlib.closing(sqlite3.connect(database)) as connection, connection:
+        for name, df in tables.items():
+            df.to_sql(name, connection, if_exists = 'replace', index = False, chunksize = 10000)
+
+            for index in index_columns(name, df):
+                connection.execute('CREATE INDEX %s ON %s (%s)' %
+                    (quote('%s_%s' % (name, '_'.join(index))), quote(name), ', '.join(quote(c) for c in index)))
+
+        connection.execute('ANALYZE')
+
+def index_columns(name, df):
+    if name in KEYS:
+        return [KEYS[name]]
+
+    if 'email' not in df.columns:
+        return []
+
+    # A numeric date column is a count of days, which is never looked up
+    if 'date' in df.columns and not pd.api.types.is_numeric_dtype(df['date']):
+        return [['email', 'date']]
+
+    return [['email']]
+
+def quote(name):
+    return '"%s"' % (name.replace('"', '""'))
+
+'''
+Retrieves the rows of a table for some subjects and/or a range of dates.
+
+Parameters
+----------
+database : file location
+    Location of the database.
+table : string
+    The name of the table.
+emails : list
+    The emails of the subjects to retrieve. If absent, all subjects are retrieved.
+start : string
+    The first date to retrieve, in YYYY-MM-DD format. If absent, there is no lower bound.
+end : string
+    The last date to retrieve, in YYYY-MM-DD format. If absent, there is no upper bound.
+foodtypes : list
+    The foodtypes to retrieve, for meal-level tables.
+columns : list
+    The columns to retrieve. If absent, all columns are retrieved.
+'''
+def query(database, table, emails = None, start = None, end = None, foodtypes = None, columns = None):
+    conditions = []
+    parameters = []
+
+    if emails:
+        conditions.append('email IN (%s)' % (', '.join('?'*len(emails))))
+        parameters += [e.lower() for e in emails]
+
+    if start:
+        conditions.append('date >= ?')
+        parameters.append(start)
+
+    if end:
+        conditions.append('date <= ?')
+        parameters.append(end)
+
+    if foodtypes:
+        conditions.append('foodtype IN (%s)' % (', '.join('?'*len(foodtypes))))
+        parameters += foodtypes
+
+    sql = 'SELECT %s FROM %s' % ('*' if columns is None else ', '.join(quote(c) for c in columns), quote(table))
+
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+
+    with contextlib.closing(sqlite3.connect(database)) as connection:
+        return pd.read_sql_query(sql, connection, params = parameters)
+
+'''
+Reads a data file, which may be a csv, Parquet or Feather file or a
+database, keeping only the rows of some subjects and/or a range of dates,
+and only the columns that are needed. The filtering is done by the
+database or the Parquet reader where possible, and only the needed
+columns are parsed.
+
+Parameters
+----------
+path : file location
+    Location of the data file.
+table : string
+    The name of the table, if the data file is a database.
+emails, start, end :
+    As for query.
+columns : list
+    The columns to read. If absent, all columns are read.
+'''
+def read(path, table = None, emails = None, start = None, end = None, columns = None):
+    if CACHE is None:
+        return load(path, table, emails, start, end, columns)
+
+    key = (os.path.abspath(path), table, tuple(emails or ()), start, end, None if columns is None else tuple(columns))
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    if key not in CACHE or CACHE[key][0] != stamp:
+        CACHE[key] = (stamp, load(path, table, emails, start, end, columns))
+
+    # The scripts add columns to the data they read, so the cached dataframe is never handed out
+    return CACHE[key][1].copy()
+
+def load(path, table, emails, start, end, columns):
+    if path.endswith(DATABASE_EXTENSIONS):
+        return query(path, table or 'day_aggregation', emails, start, end, columns = columns)
+
+    # The columns that are filtered on are read too, and dropped afterwards
+    filters = (['email'] if emails else []) + (['date'] if start or end else [])
+    needed = None if columns is None else list(columns) + [c for c in filters if c not in columns]
+
+    if path.endswith('.parquet'):
+        conditions = []
+
+        if emails:
+            conditions.append(('email', 'in', [e.lower() for e in emails]))
+
+        if start:
+            conditions.append(('date', '>=', start))
+
+        if end:
+            conditions.append(('date', '<=', end))
+
+        df = pd.read_parquet(path, columns = needed, filters = conditions or None)
+    elif path.endswith('.feather'):
+        from pyarrow import feather
+
+        # The file is memory-mapped, so only the pages of the needed columns are read
+        df = feather.read_table(path, columns = needed, memory_map = True).to_pandas()
+    else:
+        df = pd.read_csv(path, usecols = needed)
+
+    if emails:
+        df = df[df['email'].isin([e.lower() for e in emails])]
+
+    if start:
+        df = df[df['date'] >= start]
+
+    if end:
+        df = df[df['date'] <= end]
+
+    if columns is not None:
+        df = df[list(columns)]
+
+    return df.reset_index(drop = True)
+
+'''
+Saves a dataframe in the format given by the extension of its path:
+compressed Parquet (.parquet), compressed Feather (.feather), a table of
+a database, or csv otherwise.
+
+Parameters
+----------
+df : dataframe
+    The dataframe.
+path : file location
+    The path to where the dataframe should be saved.
+table : string
+    The name of the table, if the path is a database. Defaults to the
+    name of the file.
+'''
+def save(df, path, table = None):
+    # Columnar formats only allow string column names, which is what they become in csv files anyway
+    if path.endswith(COLUMNAR_EXTENSIONS):
+        df = df.rename(columns = str)
+
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index = False, compression = 'zstd')
+    elif path.endswith('.feather'):
+        df.reset_index(drop = True).to_feather(path, compression = 'zstd')
+    elif path.endswith(DATABASE_EXTENSIONS):
+        write(path, {table or os.path.splitext(os.path.basename(path))[0]: df})
+    else:
+        df.to_csv(path, index = False)
+
+'''
+Adds the options used by read to an argument parser.
+'''
+def add_arguments(parser):
+    parser.add_argument('-table', help = 'Table to read, if the input is a database')
+    parser.add_argument('-email', help = 'Only use these subjects', nargs = '+')
+    parser.add_argument('-start', help = 'Only use dates from this date (YYYY-MM-DD)')
+    parser.add_argument('-end', help = 'Only use dates up to this date (YYYY-MM-DD)')
@@ -0,0 +1,253 @@
+import resource
+import json
+import time
+import sys
+import os
+
+'''
+Notes
+-----
+This module contains a lightweight tracer for timing the stages of the
+scripts. Each stage records its wall time, CPU time, peak resident memory
+and optionally the number of rows it produced. The CPU time is that of the
+process alone. The CPU time of the child processes that finished during
+the stage, e.g. a pool of workers that was shut down, is recorded apart,
+as workers that trace their own stages already report theirs. Traces are
+saved in the Chrome trace event format, so they can be opened in a trace
+viewer such as chrome://tracing or https://ui.perfetto.dev, or compared
+across runs with
+
+    python tracing.py baseline.json trace.json
+
+When the tracer is disabled, stages do nothing but return a shared dummy.
+'''
+
+class Stage:
+    '''
+    A named stage that is being traced.
+
+    Parameters
+    ----------
+    tracer : Tracer
+        The tracer that records the stage.
+    name : string
+        The name of the stage.
+    rows : integer
+        The number of rows produced by the stage, if known. It can also be
+        set at any point before the stage ends.
+    '''
+    def __init__(self, tracer, name, rows = None):
+        self.tracer = tracer
+        self.name = name
+        self.rows = rows
+        self.peak = 0
+
+    def __enter__(self):
+        self.tracer.begin(self)
+        self.timestamp = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.children = children_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        children = children_time() - self.children
+        self.tracer.end(self, wall, cpu, children)
+        return False
+
+class NullStage:
+    '''
+    The stage returned by a disabled tracer.
+    '''
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Tracer:
+    '''
+    Creates a new tracer, which is disabled until enable is called.
+    '''
+    def __init__(self):
+        self.events = None
+        self.stack = []
+        self.resettable = None
+
+    @property
+    def enabled(self):
+        return self.events is not None
+
+    def enable(self):
+        self.events = []
+        self.resettable = os.path.exists('/proc/self/clear_refs')
+
+    def disable(self):
+        self.events = None
+        self.stack = []
+
+    '''
+    Creates a stage to be used in a with statement, e.g.
+
+        with TRACER.stage('Read Surveys') as stage:
+            surveys = pd.read_csv(surveys_file)
+            stage.rows = len(surveys.index)
+
+    Parameters
+    ----------
+    name : string
+        The name of the stage.
+    rows : integer
+        The number of rows produced by the stage, if known.
+    '''
+    def stage(self, name, rows = None):
+        if self.events is None:
+            return NULL_STAGE
+
+        return Stage(self, name, rows)
+
+    def begin(self, stage):
+        # The peak memory of every enclosing stage is brought up to date before it is reset
+        peak = self.peak_memory()
+
+        for s in self.stack:
+            s.peak = max(s.peak, peak)
+
+        self.reset_peak_memory()
+        self.stack.append(stage)
+
+    def end(self, stage, wall, cpu, children = 0):
+        stage.peak = max(stage.peak, self.peak_memory())
+        self.stack.pop()
+
+        for s in self.stack:
+            s.peak = max(s.peak, stage.peak)
+
+        args = {'cpu (ms)': round(cpu*1000, 3), 'children cpu (ms)': round(children*1000, 3),
+                'peak memory (MB)': round(stage.peak/1024.0, 1)}
+
+        if stage.rows is not None:
+            args['rows'] = int(stage.rows)
+
+        self.events.append({'name': stage.name,
+                            'ph': 'X',
+                            'ts': round(stage.timestamp*1e6),
+                            'dur': round(wall*1e6),
+                            'pid': os.getpid(),
+                            'tid': len(self.stack),
+                            'args': args})
+
+    '''
+    Adds the stages traced by another process, e.g. a worker.
+    '''
+    def extend(self, events):
+        if self.events is not None and events:
+            self.events += events
+
+    '''
+    Retrieves the peak resident memory in kB since it was last reset. If it
+    cannot be reset, the peak of the whole process is used instead.
+    '''
+    def peak_memory(self):
+        if self.resettable:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def reset_peak_memory(self):
+        if not self.resettable:
+            return
+
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            self.resettable = False
+
+    '''
+    Saves the trace. If the file already exists, the stages are added to it,
+    so that every script run by an experiment can share a single trace.
+
+    Parameters
+    ----------
+    path : file location
+        The path to where the trace should be saved.
+    '''
+    def save(self, path):
+        if self.events is None:
+            return
+
+        trace = {'traceEvents': []}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                trace = json.load(f)
+
+        trace['traceEvents'].append({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                                     'args': {'name': ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:])}})
+        trace['traceEvents'] += self.events
+
+        with open(path, 'w') as f:
+            json.dump(trace, f, indent = 1)
+
+        self.events = []
+
+TRACER = Tracer()
+
+'''
+Retrieves the CPU time in seconds of the child processes that have finished
+and been waited for, which the CPU time of the process leaves out.
+'''
+def children_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+'''
+Totals the wall time, CPU time (of the process and of its children) and
+rows of each stage of a trace, along with its highest peak memory.
+'''
+def summarise(path):
+    with open(path) as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+
+    stages = {}
+
+    for e in events:
+        s = stages.setdefault(e['name'], {'wall (ms)': 0, 'cpu (ms)': 0, 'children cpu (ms)': 0, 
+                                          'peak memory (MB)': 0, 'rows': None})
+        s['wall (ms)'] += e['dur']/1000.0
+        s['cpu (ms)'] += e['args']['cpu (ms)']
+        s['children cpu (ms)'] += e['args'].get('children cpu (ms)', 0)
+        s['peak memory (MB)'] = max(s['peak memory (MB)'], e['args']['peak memory (MB)'])
+
+        if 'rows' in e['args']:
+            s['rows'] = (s['rows'] or 0) + e['args']['rows']
+
+    return stages
+
+def compare(baseline, trace):
+    before = summarise(baseline)
+    after = summarise(trace)
+
+    print('%-40s %12s %12s %8s %10s %10s' % ('stage', 'before (ms)', 'after (ms)', 'ratio', 'before MB', 'after MB'))
+
+    for name in list(before) + [n for n in after if n not in before]:
+        b = before.get(name, {'wall (ms)': 0, 'peak memory (MB)': 0})
+        a = after.get(name, {'wall (ms)': 0, 'peak memory (MB)': 0})
+        ratio = a['wall (ms)']/b['wall (ms)'] if b['wall (ms)'] else float('nan')
+
+        print('%-40s %12.1f %12.1f %8.2f %10.1f %10.1f' %
+            (name[:40], b['wall (ms)'], a['wall (ms)'], ratio, b['peak memory (MB)'], a['peak memory (MB)']))
+
+if __name__ == "__main__":
+    compare(sys.argv[1], sys.argv[2])
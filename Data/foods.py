@@ -0,0 +1,316 @@
+import pandas as pd
+import numpy as np
+from sklearn.neighbors import KDTree, BallTree
+from scipy.spatial import distance
+import argparse
+import pickle
+import os
+
+'''
+A script to find foods with similar nutrient profiles, e.g. to suggest
+substitutions or to spot mislabelled items. As in liquids.py, the profile
+of a food is its nutrients per unit of its total amount, min-max scaled
+across all foods, and foods are compared by their euclidean distance.
+
+The profiles of the unique foods are held in a KD-tree or ball tree,
+which is saved to an index file so that it only has to be built once.
+
+Build Parameters
+----------------
+mealsfile : file location
+    Location of the meals dataset, i.e. meals.xlsx or meals.csv.
+indexfile : file location
+    The path to where the index should be saved.
+tree : string
+    Choice of tree. Valid choices are 'kd' (the default) and 'ball'.
+
+Update Parameters
+-----------------
+mealsfile : file location
+    Location of a meals dataset that may contain new foods.
+indexfile : file location
+    Location of the index, which is updated in place.
+
+Query Parameters
+----------------
+indexfile : file location
+    Location of the index.
+outputfile : file location
+    The path to where the neighbours of each food should be saved.
+foods : list of strings
+    The foods to find the neighbours of.
+foodfile : file location
+    Location of a file listing foods to find the neighbours of, with each
+    food on a new line. If neither foods nor foodfile are present, the
+    neighbours of every food are found.
+k : integer
+    The number of neighbours of each food to find.
+radius : float
+    If present, every neighbour within this distance is found instead.
+'''
+
+# The proportion of foods that can be added before the tree is rebuilt
+REBUILD_FRACTION = 0.1
+
+TREES = {'kd': KDTree, 'ball': BallTree}
+
+class FoodIndex:
+    '''
+    Creates a new index over the foods of a meals dataset.
+
+    Parameters
+    ----------
+    meals : dataframe
+        The meal items, which must have the foodName and total columns and
+        a column for each nutrient.
+    nutrients : list
+        The names of the nutrient columns.
+    tree : string
+        The type of tree, 'kd' or 'ball'.
+    '''
+    def __init__(self, meals, nutrients, tree = 'kd'):
+        foods = unique_foods(meals)
+        self.nutrients = nutrients
+        self.tree_type = tree
+        self.names = foods['foodName'].values
+        self.profiles = profiles(foods, nutrients)
+        self.rebuild()
+
+    '''
+    Refits the scaling to every food and rebuilds the tree over them.
+    '''
+    def rebuild(self):
+        self.lower = self.profiles.min(axis = 0)
+        self.span = self.profiles.max(axis = 0) - self.lower
+        self.span[self.span == 0] = 1
+
+        self.tree = TREES[self.tree_type](self.scale(self.profiles))
+        self.indexed = len(self.names)
+        self.positions = {name: i for i, name in enumerate(self.names)}
+
+    def scale(self, profiles):
+        return (profiles - self.lower)/self.span
+
+    '''
+    Adds the foods of a meals dataset that are not in the index yet.
+
+    A tree cannot be added to, so new foods are kept aside and searched
+    by brute force, under the scaling of the last rebuild, until they
+    amount to REBUILD_FRACTION of the tree, at which point it is rebuilt.
+
+    Parameters
+    ----------
+    meals : dataframe
+        The meal items.
+
+    Returns
+    -------
+    added : integer
+        The number of new foods.
+    '''
+    def add(self, meals):
+        foods = unique_foods(meals)
+        foods = foods[~foods['foodName'].isin(self.positions)]
+
+        if len(foods.index) == 0:
+            return 0
+
+        self.names = np.concatenate([self.names, foods['foodName'].values])
+        self.profiles = np.concatenate([self.profiles, profiles(foods, self.nutrients)])
+
+        for i, name in enumerate(foods['foodName'].values):
+            self.positions[name] = self.indexed + i
+
+        if len(self.names) - self.indexed > REBUILD_FRACTION*self.indexed:
+            self.rebuild()
+
+        return len(foods.index)
+
+    '''
+    Finds the k nearest neighbours of a number of foods.
+
+    Parameters
+    ----------
+    foods : list
+        The names of the foods. If absent, every food is used.
+    k : integer
+        The number of neighbours of each food. A food is not its own
+        neighbour.
+
+    Returns
+    -------
+    neighbours : dataframe
+        The food, rank, neighbour and distance of each neighbour.
+    '''
+    def kneighbors(self, foods = None, k = 5):
+        queries = self.lookup(foods)
+        points = self.scale(self.profiles[queries])
+
+        # One extra neighbour is found, as each food is usually its own nearest
+        distances, indices = self.tree.query(points, min(k + 1, self.indexed))
+
+        if len(self.names) > self.indexed:
+            pending = distance.cdist(points, self.scale(self.profiles[self.indexed:]))
+            distances = np.concatenate([distances, pending], axis = 1)
+            indices = np.concatenate([indices, np.broadcast_to(np.arange(self.indexed, len(self.names)), pending.shape)], axis = 1)
+
+        # Each food is moved past every other food, and the rest are ordered by distance
+        order = np.lexsort((distances, indices == queries[:, None]), axis = 1)[:, :k]
+        indices = np.take_along_axis(indices, order, axis = 1)
+        distances = np.take_along_axis(distances, order, axis = 1)
+        valid = indices != queries[:, None]
+
+        return pd.DataFrame({'food': np.repeat(self.names[queries], indices.shape[1])[valid.ravel()],
+                             'rank': np.tile(np.arange(1, indices.shape[1] + 1), len(queries))[valid.ravel()],
+                             'neighbour': self.names[indices[valid]],
+                             'distance': distances[valid]})
+
+    '''
+    Finds every neighbour within a distance of a number of foods.
+
+    Parameters
+    ----------
+    foods : list
+        The names of the foods. If absent, every food is used.
+    radius : float
+        The distance.
+
+    Returns
+    -------
+    neighbours : dataframe
+        As for kneighbors.
+    '''
+    def radius_neighbors(self, foods = None, radius = 0.1):
+        queries = self.lookup(foods)
+        points = self.scale(self.profiles[queries])
+
+        indices, distances = self.tree.query_radius(points, radius, return_distance = True)
+        counts = np.array([len(i) for i in indices])
+        position = np.repeat(np.arange(len(queries)), counts)
+        indices = np.concatenate(indices).astype(int)
+        distances = np.concatenate(distances)
+
+        if len(self.names) > self.indexed:
+            pending = distance.cdist(points, self.scale(self.profiles[self.indexed:]))
+            rows, cols = np.nonzero(pending <= radius)
+            position = np.concatenate([position, rows])
+            indices = np.concatenate([indices, self.indexed + cols])
+            distances = np.concatenate([distances, pending[rows, cols]])
+
+        query = queries[position]
+        neighbours = pd.DataFrame({'food': self.names[query], 'position': position,
+                                   'neighbour': self.names[indices], 'distance': distances})
+        neighbours = neighbours[query != indices]
+
+        # The queries keep the order they were given in, and their neighbours are ordered by distance
+        neighbours = neighbours.sort_values(['position', 'distance'], kind = 'mergesort')
+        neighbours.insert(1, 'rank', neighbours.groupby('position').cumcount() + 1)
+
+        return neighbours.drop(columns = ['position']).reset_index(drop = True)
+
+    def lookup(self, foods):
+        if foods is None:
+            return np.arange(len(self.names))
+
+        missing = [f for f in foods if f not in self.positions]
+
+        if missing:
+            raise KeyError('Foods not in the index: %s' % (', '.join(missing)))
+
+        return np.array([self.positions[f] for f in foods], dtype = int)
+
+    def save(self, path):
+        # Only the attributes are pickled, as an instance of a class defined in __main__ 
+        # cannot be loaded by code that imports foods as a module
+        with open(path, 'wb') as f:
+            pickle.dump(vars(self), f, protocol = pickle.HIGHEST_PROTOCOL)
+
+def load(path):
+    with open(path, 'rb') as f:
+        index = FoodIndex.__new__(FoodIndex)
+        index.__dict__.update(pickle.load(f))
+
+    return index
+
+'''
+Retrieves the first item of each food that has a total amount, as the 
+profiles of items with no total amount cannot be computed.
+'''
+def unique_foods(meals):
+    foods = meals[meals['total'] > 0]
+    return foods.drop_duplicates(subset = ['foodName'])
+
+def profiles(foods, nutrients):
+    return foods[nutrients].fillna(0).values/foods['total'].values[:, None]
+
+def read_meals(mealsfile, nutrients):
+    columns = ['foodName', 'total'] + nutrients
+
+    if mealsfile.endswith('.xlsx'):
+        return pd.read_excel(mealsfile, usecols = columns)
+
+    return pd.read_csv(mealsfile, usecols = columns)
+
+def build(args, directory, nutrients):
+    index = FoodIndex(read_meals(os.path.join(directory, args.mealsfile), nutrients), nutrients, args.tree)
+    index.save(os.path.join(directory, args.indexfile))
+
+    print('Indexed %d foods' % (len(index.names)))
+
+def update(args, directory, nutrients):
+    index = load(os.path.join(directory, args.indexfile))
+    added = index.add(read_meals(os.path.join(directory, args.mealsfile), nutrients))
+    index.save(os.path.join(directory, args.indexfile))
+
+    print('Added %d foods, %d are awaiting a rebuild' % (added, len(index.names) - index.indexed))
+
+def query(args, directory, nutrients):
+    index = load(os.path.join(directory, args.indexfile))
+    foods = args.foods
+
+    if args.foodfile:
+        with open(os.path.join(directory, args.foodfile)) as f:
+            foods = (foods or []) + f.read().splitlines()
+
+    if args.radius is not None:
+        neighbours = index.radius_neighbors(foods, args.radius)
+    else:
+        neighbours = index.kneighbors(foods, args.k)
+
+    neighbours.to_csv(os.path.join(directory, args.outputfile), index = False)
+
+def main():
+    directory = os.path.dirname(__file__)
+
+    with open(os.path.join(directory, 'nutrient_columns.txt')) as f:
+        nutrients = f.read().splitlines()
+
+    parser = argparse.ArgumentParser()
+
+    sp = parser.add_subparsers()
+
+    build_parser = sp.add_parser('build', help = 'Build the index')
+    build_parser.add_argument('mealsfile', help = 'Meals file')
+    build_parser.add_argument('indexfile', help = 'Index file')
+    build_parser.add_argument('-tree', help = 'Type of tree', choices = list(TREES), default = 'kd')
+    build_parser.set_defaults(func = build)
+
+    update_parser = sp.add_parser('update', help = 'Add new foods to the index')
+    update_parser.add_argument('mealsfile', help = 'Meals file')
+    update_parser.add_argument('indexfile', help = 'Index file')
+    update_parser.set_defaults(func = update)
+
+    query_parser = sp.add_parser('query', help = 'Find the neighbours of foods')
+    query_parser.add_argument('indexfile', help = 'Index file')
+    query_parser.add_argument('outputfile', help = 'Output file')
+    query_parser.add_argument('-foods', help = 'Foods to find the neighbours of', nargs = '+')
+    query_parser.add_argument('-foodfile', help = 'File listing foods to find the neighbours of')
+    query_parser.add_argument('-k', help = 'Number of neighbours', type = int, default = 5)
+    query_parser.add_argument('-radius', help = 'Find every neighbour within this distance', type = float)
+    query_parser.set_defaults(func = query)
+
+    args = parser.parse_args()
+    args.func(args, directory, nutrients)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import pandas as pd
+import numpy as np
+import argparse
+import os
+
+'''
+A script to generate a synthetic cohort with the same schema as the real
+dataset, which cannot be shared. The generated files can be fed to
+global_preprocessing.py and the experiment scripts in place of the real
+ones, e.g. for benchmarking.
+
+Parameters
+----------
+outputfolder : directory location
+    Location of the directory to place meals.xlsx (or meals.csv),
+    surveys.csv, questionnaires.csv and liquids.csv in.
+items : integer
+    The approximate number of meal items to generate.
+days : integer
+    The maximum number of days recorded by each subject.
+foods : integer
+    The number of distinct foods to draw the meal items from.
+seed : integer
+    The random seed.
+csv : flag
+    If this flag is present, the meals are written to meals.csv instead of
+    meals.xlsx. Meals are always written as csv when they exceed the
+    number of rows an Excel sheet can hold.
+'''
+
+NUTRIENTS = ['Energy, with dietary fibre (kJ)',
+             'Protein (g)',
+             'Total fat (g)',
+             'Carbohydrates',
+             'Total sugars (g)',
+             'Added sugars (g)',
+             'Dietary fibre (g)',
+             'Vitamin A retinol equivalents (µg)',
+             'Thiamin (B1) (mg)',
+             'Riboflavin (B2) (mg)',
+             'Niacin (B3) (mg)',
+             'Total Folates  (µg)',
+             'Vitamin B6 (mg)',
+             'Vitamin B12  (µg)',
+             'Vitamin C (mg)',
+             'Vitamin E (mg)',
+             'Calcium (Ca) (mg)',
+             'Iodine (I) (µg)',
+             'Iron (Fe) (mg)',
+             'Magnesium (Mg) (mg)',
+             'Phosphorus (P) (mg)',
+             'Potassium (K) (mg)',
+             'Selenium (Se) (µg)',
+             'Sodium (Na) (mg)',
+             'Zinc (Zn) (mg)',
+             'Saturated fat (g)',
+             'Monounsaturated fat (g)',
+             'Polyunsaturated fat (g)']
+
+# Typical amount of each nutrient per gram of food
+NUTRIENT_DENSITIES = [8, 0.06, 0.05, 0.15, 0.05, 0.02, 0.02, 0.5, 0.001, 0.0015, 0.02, 0.2, 0.001, 0.003,
+                      0.1, 0.01, 1, 0.1, 0.01, 0.3, 1.5, 2.5, 0.1, 2.5, 0.01, 0.02, 0.02, 0.01]
+
+FOODTYPES = ['Breakfast', 'Lunch', 'Dinner', 'Snacks & Drinks']
+
+WATER = ['Tap water', 'Bore water', 'Frantelle Water', 'Bottled/filtered/tank water', 'Cool Ridge Water']
+
+MANUAL_DISCARDS = ["Nachos Vegetables with Guac, Guzman Y Gomez ",
+                   "Moroccan lamb, Sumo Salad"]
+
+EXCEL_ROWS = 1048575
+ITEMS_PER_DAY = 12
+CHUNK_SUBJECTS = 20000
+
+def main():
+    directory = os.path.dirname(__file__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outputfolder', help = 'Output folder')
+    parser.add_argument('-items', help = 'Number of meal items', type = int, default = 10000)
+    parser.add_argument('-days', help = 'Maximum days per subject', type = int, default = 4)
+    parser.add_argument('-foods', help = 'Number of distinct foods', type = int, default = 1000)
+    parser.add_argument('-seed', help = 'Random seed', type = int, default = 0)
+    parser.add_argument('-csv', help = 'Write meals.csv instead of meals.xlsx', action = 'store_true')
+
+    args = parser.parse_args()
+
+    generate(os.path.join(directory, args.outputfolder), args.items, args.days, args.foods, args.seed, args.csv)
+
+'''
+Generates a synthetic cohort and writes its files to a directory.
+
+Parameters
+----------
+outputfolder : string
+    The output directory.
+items : integer
+    The approximate number of meal items to generate.
+days : integer
+    The maximum number of days recorded by each subject.
+foods : integer
+    The number of distinct foods.
+seed : integer
+    The random seed.
+csv : boolean
+    Whether to write the meals as csv rather than Excel.
+'''
+def generate(outputfolder, items, days = 4, foods = 1000, seed = 0, csv = False):
+    rng = np.random.default_rng(seed)
+    preprocessing = os.path.join(os.path.dirname(__file__), os.pardir, 'Preprocessing')
+
+    with open(os.path.join(preprocessing, 'survey_columns.txt')) as f:
+        survey_columns = f.read().splitlines()
+
+    with open(os.path.join(preprocessing, 'questionnaire_columns.txt')) as f:
+        questionnaire_columns = f.read().splitlines()
+
+    os.makedirs(outputfolder, exist_ok = True)
+
+    # Every subject records between 1 and days days of roughly ITEMS_PER_DAY items each
+    subjects = max(1, int(round(items/(ITEMS_PER_DAY*(days + 1)/2.0))))
+    subject_days = rng.integers(1, days + 1, subjects)
+    emails = np.array(['Subject%d@example.com' % i for i in range(subjects)], dtype = object)
+    starts = np.datetime64('2017-03-01') + rng.integers(0, 365, subjects).astype('timedelta64[D]')
+
+    catalogue = food_catalogue(rng, foods)
+    catalogue[['foodName', 'is liquid', 'is water']].to_csv(os.path.join(outputfolder, 'liquids.csv'), index = False)
+
+    surveys = survey_table(rng, emails, survey_columns)
+    surveys.to_csv(os.path.join(outputfolder, 'surveys.csv'), index = False)
+
+    questionnaires = questionnaire_table(rng, emails, starts, subject_days, questionnaire_columns)
+    questionnaires.to_csv(os.path.join(outputfolder, 'questionnaires.csv'), index = False)
+
+    # The meals are generated in chunks of subjects so that large cohorts do not have to fit in memory
+    meals_csv = csv or items > EXCEL_ROWS
+    meals_file = os.path.join(outputfolder, 'meals.csv' if meals_csv else 'meals.xlsx')
+    chunks = []
+    offset = 0
+
+    for first in range(0, subjects, CHUNK_SUBJECTS):
+        last = min(first + CHUNK_SUBJECTS, subjects)
+        meals = meal_table(rng, emails[first:last], starts[first:last], subject_days[first:last], catalogue, offset)
+        offset += len(meals.index)
+
+        if meals_csv:
+            meals.to_csv(meals_file, index = False, mode = 'w' if first == 0 else 'a', header = first == 0)
+        else:
+            chunks.append(meals)
+
+    if not meals_csv:
+        pd.concat(chunks).to_excel(meals_file, index = False)
+
+    print('Generated Synthetic Cohort:\nSubjects: %d\nQuestionnaire Entries: %d\nMeal Items: %d\n' %
+        (subjects, len(questionnaires.index), offset))
+
+'''
+Creates the list of foods along with their nutrient content per gram.
+'''
+def food_catalogue(rng, foods):
+    names = WATER + MANUAL_DISCARDS + ['Food %d' % i for i in range(max(0, foods - len(WATER) - len(MANUAL_DISCARDS)))]
+    catalogue = pd.DataFrame({'foodName': names})
+
+    catalogue['is water'] = catalogue['foodName'].isin(WATER)
+    catalogue['is liquid'] = catalogue['is water'] | (rng.random(len(names)) < 0.2)
+
+    # Water has no nutrients and liquids are less dense than solids
+    densities = rng.lognormal(0, 0.75, (len(names), len(NUTRIENTS)))*np.array(NUTRIENT_DENSITIES)
+    densities[catalogue['is liquid'].values] *= 0.3
+    densities[catalogue['is water'].values] = 0
+
+    for i, c in enumerate(NUTRIENTS):
+        catalogue[c] = densities[:, i]
+
+    # Popular foods are eaten far more often than others
+    popularity = 1.0/np.arange(1, len(names) + 1)
+    popularity[len(WATER):len(WATER) + len(MANUAL_DISCARDS)] *= 0.01
+    catalogue['popularity'] = popularity/popularity.sum()
+
+    return catalogue
+
+'''
+Creates the surveys, including a few subjects with an unknown gender,
+erroneous measurements or clashing surveys.
+'''
+def survey_table(rng, emails, columns):
+    n = len(emails)
+    surveys = pd.DataFrame({c: rng.integers(0, 6, n).astype(float) for c in columns})
+
+    # Unanswered questions are left blank
+    surveys = surveys.mask(rng.random(surveys.shape) < 0.05)
+
+    surveys['email'] = emails
+    surveys['age'] = rng.integers(18, 70, n)
+    surveys['gender'] = rng.choice([1, 2, 3], n, p = [0.49, 0.49, 0.02])
+    surveys['height'] = np.round(np.where(surveys['gender'] == 1, rng.normal(178, 7, n), rng.normal(164, 7, n)), 1)
+    surveys['weight'] = np.round(np.where(surveys['gender'] == 1, rng.normal(84, 13, n), rng.normal(70, 14, n)), 1)
+    surveys.loc[rng.random(n) < 0.01, 'height'] = 0
+
+    for c in ['fruit_serves', 'veg_serves', 'cereal_serves', 'dairy_serves']:
+        surveys[c] = rng.integers(0, 7, n)
+
+    clashes = surveys.sample(frac = 0.01, random_state = rng.integers(2**31))
+    clashes['weight'] += 1
+
+    return pd.concat([surveys, clashes]).sample(frac = 1, random_state = rng.integers(2**31))
+
+'''
+Creates one questionnaire per recorded day, including a few clashing entries.
+'''
+def questionnaire_table(rng, emails, starts, subject_days, columns):
+    n = subject_days.sum()
+    subjects = np.repeat(np.arange(len(emails)), subject_days)
+    day = np.arange(n) - np.repeat(np.cumsum(subject_days) - subject_days, subject_days)
+
+    questionnaires = pd.DataFrame({c: rng.integers(1, 6, n) for c in columns})
+    questionnaires['username'] = emails[subjects]
+    questionnaires['date'] = (starts[subjects] + day.astype('timedelta64[D]')).astype(str)
+
+    for c in columns:
+        if c.startswith('q3_check'):
+            questionnaires[c] = rng.integers(0, 2, n)
+
+    questionnaires['q3_check_6_answer'] = np.where(questionnaires['q3_check_6'] == 1, 'Other', '')
+
+    clashes = questionnaires.sample(frac = 0.005, random_state = rng.integers(2**31))
+    clashes['q1_value'] = clashes['q1_value'] % 5 + 1
+
+    return pd.concat([questionnaires, clashes])[columns]
+
+'''
+Creates the meal items eaten by a group of subjects on each of their recorded days.
+'''
+def meal_table(rng, emails, starts, subject_days, catalogue, offset):
+    days = subject_days.sum()
+    subjects = np.repeat(np.arange(len(emails)), subject_days)
+    day = np.arange(days) - np.repeat(np.cumsum(subject_days) - subject_days, subject_days)
+    dates = starts[subjects] + day.astype('timedelta64[D]')
+
+    day_items = np.maximum(rng.poisson(ITEMS_PER_DAY, days), 1)
+    n = day_items.sum()
+    item_days = np.repeat(np.arange(days), day_items)
+
+    foods = rng.choice(len(catalogue.index), n, p = catalogue['popularity'].values)
+    amounts = rng.integers(1, 4, n)
+    sizes = np.round(rng.lognormal(4.5, 0.6, n))
+    totals = amounts*sizes
+    times = (dates[item_days] + rng.integers(6*3600, 23*3600, n).astype('timedelta64[s]')).astype(str)
+    times = np.char.replace(times, 'T', ' ')
+
+    meals = pd.DataFrame({'id': np.arange(offset, offset + n),
+                          'date': times,
+                          'username': emails[subjects[item_days]],
+                          'foodtype': np.array(FOODTYPES)[rng.integers(0, len(FOODTYPES), n)],
+                          'recordingtime': times,
+                          'location': rng.choice(['Home', 'Work', 'Restaurant', 'Other'], n),
+                          'amount': amounts,
+                          'serving unit': np.where(catalogue['is liquid'].values[foods], 'ml', 'g'),
+                          'serving size': sizes,
+                          'weigh': rng.integers(0, 2, n),
+                          'inputtype': rng.integers(0, 3, n),
+                          'foodName': catalogue['foodName'].values[foods],
+                          'total': totals})
+
+    meals['serving unit'] = sizes.astype(int).astype(str).astype(object) + meals['serving unit']
+
+    densities = catalogue[NUTRIENTS].values[foods]*totals[:, None]
+    densities[rng.random(densities.shape) < 0.01] = np.nan
+
+    nutrients = pd.DataFrame(np.round(densities, 3), columns = NUTRIENTS)
+
+    return pd.concat([meals, nutrients], axis = 1)
+
+if __name__ == "__main__":
+    main()
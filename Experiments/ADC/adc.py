@@ -1,8 +1,11 @@
-import pandas as pd
 import numpy as np
 import argparse
+import sys
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'Common'))
+import store
+
 INTAKES = ['drinks', 
            'Energy, with dietary fibre (kJ)', 
            'Protein (g)', 
@@ -42,12 +45,12 @@ def main():
 
     args = parser.parse_args()
 
-    df = pd.read_csv(os.path.join(directory, args.infile))
+    df = store.read(os.path.join(directory, args.infile))
 
     for i in INTAKES:
         df[i] = df[i]/df['total']
 
-    df.to_csv(os.path.join(directory, args.outfile), index = False)
+    store.save(df, os.path.join(directory, args.outfile))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
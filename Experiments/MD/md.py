@@ -1,8 +1,11 @@
-import pandas as pd
 import numpy as np
 import argparse
+import sys
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'Common'))
+import store
+
 def main():
     directory = os.path.dirname(__file__)
 
@@ -12,7 +15,7 @@ def main():
 
     args = parser.parse_args()
 
-    df = pd.read_csv(os.path.join(directory, args.infile))
+    df = store.read(os.path.join(directory, args.infile))
 
     nonlipids = {'Protein (g)': 'Energy Contribution of Proteins',
                  'Carbohydrates': 'Energy Contribution of Carbohydrates',
@@ -31,7 +34,7 @@ def main():
     for c in lipids:
         df[lipids[c]] = 37.7*df[c]/df['Energy, with dietary fibre (kJ)']
 
-    df[df['Energy, with dietary fibre (kJ)'] > 0].to_csv(os.path.join(directory, args.outfile), index = False)
+    store.save(df[df['Energy, with dietary fibre (kJ)'] > 0], os.path.join(directory, args.outfile))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,8 +1,11 @@
-import pandas as pd
 import numpy as np
 import argparse
+import sys
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'Common'))
+import store
+
 def l1_norm(row, columns):
     divisor = 0
 
@@ -20,7 +23,7 @@ def main():
 
     args = parser.parse_args()
 
-    df = pd.read_csv(os.path.join(directory, args.infile))
+    df = store.read(os.path.join(directory, args.infile))
 
     df['Sodium (Na) (mg)'] = df['Sodium (Na) (mg)']/1000
     df.rename(columns = {'Sodium (Na) (mg)': 'Sodium (Na) (g)'}, inplace = True)
@@ -37,7 +40,7 @@ def main():
     for v in key_values:
         df[v] = df[v]/df['l1 norm']
 
-    df.to_csv(os.path.join(directory, args.outfile), index = False)
+    store.save(df, os.path.join(directory, args.outfile))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
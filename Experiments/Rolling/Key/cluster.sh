@@ -0,0 +1,2 @@
+#!/bin/bash
+python3 ../../cluster_analysis.py ../Data/rolling_aggregation.csv Rolling/Key/input_columns.txt kmeans 2 -pca 5 -loadings Rolling/Key/pca_loadings.csv -export cluster Rolling/Key/pca_clusters.csv
\ No newline at end of file
@@ -0,0 +1,2 @@
+#!/bin/bash
+python3 ../../label.py ../Data/rolling_aggregation.csv Rolling/Key/pca_clusters.csv cluster Rolling/Key/raw_clusters.csv cluster
\ No newline at end of file
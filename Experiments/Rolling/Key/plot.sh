@@ -0,0 +1,3 @@
+#!/bin/bash
+python3 ../../plot.py Rolling/Key/raw_clusters.csv -bar_columns Rolling/Key/bar_columns.txt -box_columns Rolling/Key/box_columns.txt -cluster_column cluster Rolling/Key/raw_plots
+python3 ../../plot.py Rolling/Key/pca_clusters.csv -box_columns Rolling/Key/pca_components.txt -cluster_column cluster Rolling/Key/pca_plots
\ No newline at end of file
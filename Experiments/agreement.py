@@ -0,0 +1,215 @@
+import pandas as pd
+import numpy as np
+import argparse
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from tracing import TRACER
+import store
+
+'''
+A script to measure how much the clusterings of a number of experiments
+agree with each other, e.g. those of Raw/Key, ADC/Key and RNI/Full. The
+labelled days of each experiment are matched on their email and date, and
+the adjusted Rand index (ARI), normalised mutual information (NMI) and
+V-measure of every pair of experiments are computed from their
+contingency table.
+
+Parameters
+----------
+labelfiles : list of file locations
+    Locations of the labelled data files of the experiments, as written by
+    label.py, e.g. Raw/Key/raw_clusters.csv. They may be in csv, Parquet
+    (.parquet) or Feather (.feather) format, and only the email, date and
+    label columns are read from them. Each experiment is named after the
+    directory of its file, or after the path of its file from the
+    directory the files share if two of them are in the same directory.
+outputfolder : directory location
+    Location of the directory to place the ari.csv, nmi.csv and
+    v_measure.csv matrices in.
+column : string
+    The name of the column that encodes the cluster labels. Noise points,
+    labelled -1 by HDBSCAN, are treated as a cluster of their own. Days
+    with a missing label in any of the files are left out.
+average : string
+    How the entropies of the two clusterings are averaged to normalise
+    their mutual information: arithmetic, geometric (the default), min or
+    max. With the arithmetic mean, the NMI is equal to the V-measure.
+table, email, start, end :
+    As for cluster_analysis.py.
+trace : file location
+    If present, a trace of the time and memory used by each stage is
+    saved to this file.
+'''
+def main(argv = None):
+    directory = os.path.dirname(__file__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('labelfiles', help = 'Labelled data files of the experiments', nargs = '+')
+    parser.add_argument('outputfolder', help = 'Output folder')
+    parser.add_argument('-column', help = 'Cluster column', default = 'cluster')
+    parser.add_argument('-average', help = 'Normalisation of the NMI', default = 'geometric',
+                        choices = ['arithmetic', 'geometric', 'min', 'max'])
+    parser.add_argument('-trace', help = 'Save a trace of the stages')
+    store.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        TRACER.enable()
+
+    names = experiment_names(args.labelfiles)
+
+    if len(set(names)) < len(names):
+        parser.error('each label file can only be compared once')
+
+    with TRACER.stage('Read Labels') as stage:
+        labels = []
+
+        for name, f in zip(names, args.labelfiles):
+            df = store.read(os.path.join(directory, f), args.table, args.email, args.start, args.end,
+                            ['email', 'date', args.column])
+            labels.append(df.set_index(['email', 'date'])[args.column].rename(name))
+
+        # Only the days that every experiment has labelled are compared
+        labels = pd.concat(labels, axis = 1, join = 'inner')
+        missing = labels.isna().any(axis = 1)
+        labels = labels[~missing]
+        stage.rows = len(labels.index)
+
+    if missing.any():
+        print('Leaving out %d days with a missing label' % (missing.sum()))
+
+    print('Comparing %d experiments over %d days' % (len(names), len(labels.index)))
+
+    with TRACER.stage('Agreement', len(labels.index)):
+        ari, nmi, v_measure = agreement(labels.values, args.average)
+
+    path = os.path.join(directory, args.outputfolder)
+    os.makedirs(path, exist_ok = True)
+
+    for title, filename, matrix in [('ARI', 'ari', ari), ('NMI', 'nmi', nmi), ('V-measure', 'v_measure', v_measure)]:
+        matrix = pd.DataFrame(matrix, index = names, columns = names)
+        matrix.to_csv(os.path.join(path, '%s.csv' % (filename)), float_format = '%.4f')
+
+        print('\n%s' % (title))
+        print(matrix.round(4).to_string())
+
+    if args.trace:
+        TRACER.save(os.path.join(directory, args.trace))
+
+'''
+Names each experiment after the directory of its label file. If two of
+the files are in the same directory, each is named after its path from
+the directory that all the files share instead.
+'''
+def experiment_names(labelfiles):
+    names = [os.path.dirname(f) or f for f in labelfiles]
+
+    if len(set(names)) == len(names):
+        return names
+
+    paths = [os.path.abspath(f) for f in labelfiles]
+    common = os.path.commonpath([os.path.dirname(p) for p in paths])
+
+    return [os.path.relpath(p, common) for p in paths]
+
+'''
+Computes the agreement between every pair of columns of a table of
+cluster labels. The labels of each column are first mapped to the codes
+0 to k - 1, so that the contingency table of a pair of columns is a
+single bincount of their combined codes.
+
+Parameters
+----------
+labels : array_like
+    The cluster labels, with a row for each datapoint and a column for
+    each clustering. None of them can be missing.
+average : string
+    How the entropies are averaged to normalise the mutual information.
+
+Returns
+-------
+ari : array_like
+    The adjusted Rand index of each pair of clusterings.
+nmi : array_like
+    The normalised mutual information of each pair of clusterings.
+v_measure : array_like
+    The V-measure of each pair of clusterings.
+'''
+def agreement(labels, average = 'geometric'):
+    n, m = labels.shape
+    codes = []
+    sizes = []
+
+    for j in range(m):
+        c, uniques = pd.factorize(labels[:, j])
+
+        # Missing labels are given the code -1, which would be counted in the last bin
+        if (c < 0).any():
+            raise ValueError('Clustering %d has missing labels' % (j))
+
+        codes.append(c.astype(np.int64))
+        sizes.append(len(uniques))
+
+    ari = np.ones((m, m))
+    nmi = np.ones((m, m))
+    v_measure = np.ones((m, m))
+
+    for i in range(m):
+        for j in range(i + 1, m):
+            table = np.bincount(codes[i]*sizes[j] + codes[j], minlength = sizes[i]*sizes[j])
+            table = table.reshape(sizes[i], sizes[j])
+
+            ari[i, j] = ari[j, i] = adjusted_rand(table)
+            nmi[i, j], v_measure[i, j] = information(table, average)
+            nmi[j, i], v_measure[j, i] = nmi[i, j], v_measure[i, j]
+
+    return ari, nmi, v_measure
+
+def pairs(x):
+    return (x*(x - 1)/2).sum()
+
+def adjusted_rand(table):
+    n = table.sum()
+    index = pairs(table)
+    rows = pairs(table.sum(axis = 1))
+    columns = pairs(table.sum(axis = 0))
+
+    expected = rows*columns/pairs(np.array([n]))
+    maximum = (rows + columns)/2
+
+    # Both clusterings put every datapoint in one cluster, or every datapoint in its own
+    if maximum == expected:
+        return 1.0
+
+    return (index - expected)/(maximum - expected)
+
+def entropy(counts):
+    p = counts[counts > 0]/counts.sum()
+    return -(p*np.log(p)).sum()
+
+def information(table, average):
+    n = table.sum()
+    rows = table.sum(axis = 1)
+    columns = table.sum(axis = 0)
+
+    i, j = np.nonzero(table)
+    nij = table[i, j]
+    mutual = (nij/n*np.log(n*nij/(rows[i]*columns[j].astype(float)))).sum()
+
+    hu = entropy(rows)
+    hv = entropy(columns)
+
+    # Two clusterings with a single cluster each agree perfectly
+    if hu == 0 and hv == 0:
+        return 1.0, 1.0
+
+    mean = {'arithmetic': (hu + hv)/2, 'geometric': np.sqrt(hu*hv), 'min': min(hu, hv), 'max': max(hu, hv)}[average]
+    nmi = mutual/mean if mean > 0 else 0.0
+
+    return nmi, 2*mutual/(hu + hv)
+
+if __name__ == "__main__":
+    main()
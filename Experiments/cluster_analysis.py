@@ -1,10 +1,16 @@
-import pandas as pd
 import numpy as np
 from clusterkit import ClusterKit
 from sklearn import preprocessing
+from sklearn.feature_extraction.text import TfidfTransformer
+from scipy import sparse
 import argparse
+import sys
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from tracing import TRACER
+import store
+
 '''
 The script used to conduct all the k-means++ clustering experiments.
 
@@ -12,21 +18,44 @@ General Parameters
 ------------------
 inputfile : file location
     Location of the clustering input data. The input file should be 
-    in csv format.
+    in csv, Parquet (.parquet) or Feather (.feather) format, or an SQLite 
+    database written by global_preprocessing.py. Only the input columns 
+    are read from it.
+table : string
+    The table to use if the input file is a database. Defaults to 
+    day_aggregation.
+email : list of strings
+    If present, only the days of these subjects are used.
+start, end : string
+    If present, only the days in this range (YYYY-MM-DD) are used.
 columns : file location
     Location of a file listing the columns to use as input features, 
-    with each column on a new line.
+    with each column on a new line. It may also be a food occurrence 
+    matrix written by global_preprocessing.py, i.e. day_foods.npz or 
+    subject_foods.npz, to cluster what was eaten rather than the input 
+    file's columns. The rows of the matrix are those of the input file, 
+    so email, start and end cannot be used with it.
 scaler : string
     Choice of scaling algorithm. Valid choices are:
         'minax': Min-max normalization (the default)
         'standard': Standardization
         'robust' Sklearn's robust scaling
+        'maxabs' Sklearn's max-abs scaling, which keeps sparse input sparse
+        'tfidf' TF-IDF weighting of occurrence counts (the default for 
+                food occurrence matrices)
         'none' No scaling
+trace : file location
+    If present, a trace of the time and memory used by each stage is 
+    saved to this file.
 command: string
     Choice of command. Valid choices are:
         'pca': Investigate the effects of component selection on PCA results.
         'silhouette': Produce a silhouette diagram of a dataset given labels.
         'kmeans' Apply k-means++ to cluster the dataset.
+        'stability' Assess the stability of a k-means++ clustering.
+        'gap' Compute the gap statistic of k-means++ for a range of k.
+        'hdbscan' Apply HDBSCAN to cluster the dataset, labelling noise -1.
+        'search' Search for the subset of the input columns that clusters best.
 
 PCA Parameters
 --------------
@@ -48,51 +77,286 @@ k : integer
     The number of clusters to assign.
 pca : integer
     The number of PCA components to use.
+svd : integer
+    The number of truncated SVD components to use. Unlike PCA, it can be 
+    applied to food occurrence matrices without densifying them.
 loadings : file location
-    The path to where the PCA loadings should be saved. Does nothing 
-    if PCA is not used.
+    The path to where the PCA (or SVD) loadings should be saved. Does 
+    nothing if neither is used.
 silhouette : flag
     If this flag is present, the script will display the silhouette 
     diagram of the clustering results.
 export : file location
-    The path to where the newly clustered data file should be saved.
+    The path to where the newly clustered data file should be saved. It 
+    is saved as Parquet or Feather if its extension is .parquet or 
+    .feather, and as csv otherwise, as are the loadings.
+tsne : directory location
+    If present, the clustered dataset is embedded in two dimensions with 
+    Barnes-Hut t-SNE, and the coordinates are exported in the tsne 1 and 
+    tsne 2 columns, to be plotted with plot.py's scatter option. The 
+    coordinates are cached in this directory by the contents of the 
+    dataset, so they are only computed again if it changes.
+perplexity : float
+    The t-SNE perplexity.
+
+HDBSCAN Parameters
+------------------
+size : integer
+    The smallest number of days a cluster can have.
+min_samples : integer
+    The number of neighbours a day needs to be in a dense region. Larger 
+    values label more days as noise. Defaults to size.
+tree : string
+    The tree to find neighbours with. Valid choices are 'kd' (the default) 
+    and 'ball'. The neighbours in a food occurrence matrix that is not 
+    reduced with svd are found by brute force instead.
+pca, svd, loadings, export, tsne, perplexity : 
+    As for kmeans. Noise is exported with the label -1.
+
+Stability Parameters
+--------------------
+k : integer
+    The number of clusters to assign.
+samples : integer
+    The number of resamples to refit k-means++ to.
+fraction : float
+    The size of each resample as a fraction of the dataset. Defaults to 
+    1 for bootstraps and 0.8 for subsamples.
+subsample : flag
+    If this flag is present, resamples are drawn without replacement 
+    instead of bootstrapped.
+processes : integer
+    The number of processes to refit with. Defaults to the number of CPUs.
+pca, svd, loadings, export, tsne, perplexity : 
+    As for kmeans. The exported file also holds the consensus labels and 
+    their consensus indices.
+
+Gap Parameters
+--------------
+kmin, kmax : integer
+    The range of the number of clusters to compute the gap statistic for.
+references : integer
+    The number of uniform reference datasets.
+n_init : integer
+    The number of k-means++ initialisations for each fit.
+processes : integer
+    The number of processes to fit with. Defaults to the number of CPUs.
+cache : file location
+    Location of a csv file to cache the fits in, so that extending the 
+    range of k only fits the new values.
+pca, svd : 
+    As for kmeans. A food occurrence matrix must be reduced with svd, as
+    the reference datasets are drawn from a box around the dense data.
+
+Search Parameters
+-----------------
+k : integer
+    The number of clusters to assign.
+method : string
+    How each subset is scored. Valid choices are:
+        'silhouette': The mean silhouette coefficient of its k-means++ 
+                      clustering (the default)
+        'stability': The mean Jaccard stability of the clusters over 
+                     bootstrap refits
+subsets : list of file locations
+    Column files, like the columns file, to score. Their columns must be 
+    listed in the columns file, which is scaled as a whole. If absent, a 
+    greedy search over the columns of the columns file is run instead.
+backward : flag
+    If this flag is present, the search starts from all the columns and 
+    removes one at a time, rather than starting from none and adding one 
+    at a time. It stops when no column improves the score.
+steps : integer
+    If present, the largest number of columns the search adds or removes.
+pca : integer
+    The number of PCA components to reduce each subset to.
+n_init : integer
+    The number of k-means++ initialisations for each fit.
+samples : integer
+    The number of bootstrap refits for the stability score.
+processes : integer
+    The number of processes to cluster with. Defaults to the number of CPUs.
+cache : file location
+    Location of a csv file to cache the score of each subset in, so that 
+    a search can be resumed or extended without clustering a subset again.
+output : file location
+    If present, the best subset is saved to this file, as a columns file.
 '''
 
 def pca(args, ck, directory):
-    ck.investigate_pca(args.threshold)
+    with TRACER.stage('Investigate PCA'):
+        ck.investigate_pca(args.threshold)
 
 def silhouette(args, ck, directory):
     preclustering(args, ck)
     ck.labels = ck.rawdata[args.label]
-    ck.silhouette(args.k)
+
+    with TRACER.stage('Silhouette', len(ck.labels)):
+        ck.silhouette(args.k)
 
 def preclustering(args, ck):
     if args.pca:
-        ck.pca(args.pca)
+        with TRACER.stage('PCA', ck.datapoints.shape[0]):
+            ck.pca(args.pca)
+
+    if args.svd:
+        with TRACER.stage('SVD', ck.datapoints.shape[0]):
+            ck.svd(args.svd)
 
 def postclustering(args, ck, directory):
-    if args.loadings:
-        ck.loadings.to_csv(os.path.join(directory, args.loadings), index = False)
+    if args.tsne:
+        with TRACER.stage('t-SNE', ck.datapoints.shape[0]):
+            ck.embed(args.perplexity, os.path.join(directory, args.tsne))
+
+    with TRACER.stage('Export'):
+        if args.loadings:
+            store.save(ck.loadings, os.path.join(directory, args.loadings))
 
-    if args.export:
-        ck.export(args.export[0]).to_csv(os.path.join(directory, args.export[1]), index = False)
+        if args.export:
+            store.save(ck.export(args.export[0]), os.path.join(directory, args.export[1]))
 
 def kmeans(args, ck, directory):
     preclustering(args, ck)
-    ck.kmeans(args.k)
+
+    with TRACER.stage('KMeans', ck.datapoints.shape[0]):
+        ck.kmeans(args.k)
 
     if args.silhouette:
-        ck.silhouette(args.k)
+        with TRACER.stage('Silhouette', len(ck.labels)):
+            ck.silhouette(args.k)
+
+    postclustering(args, ck, directory)
+
+def hdbscan(args, ck, directory):
+    preclustering(args, ck)
+
+    with TRACER.stage('HDBSCAN', ck.datapoints.shape[0]):
+        ck.hdbscan(args.size, args.min_samples, args.tree + '_tree')
+
+    labels, populations = np.unique(ck.labels, return_counts = True)
+    clusters = dict(zip(labels, populations))
+
+    print('HDBSCAN: %d clusters, %d noise points' % (len(labels[labels >= 0]), clusters.get(-1, 0)))
+
+    for l in labels[labels >= 0]:
+        print('Cluster %d: Size %d' % (l, clusters[l]))
+
+    print('')
+
+    postclustering(args, ck, directory)
+
+def stability(args, ck, directory):
+    preclustering(args, ck)
+
+    with TRACER.stage('KMeans', ck.datapoints.shape[0]):
+        ck.kmeans(args.k)
+
+    with TRACER.stage('Stability', ck.datapoints.shape[0]):
+        jaccard, dissolved = ck.stability(args.k, args.samples, args.fraction, not args.subsample, args.processes)
+
+    populations = np.bincount(ck.labels, minlength = args.k)
+    agreement = np.mean(ck.consensus[0] == ck.labels)
+
+    print('Cluster Stability (%d resamples):' % (args.samples))
+
+    for i in range(args.k):
+        print('Cluster %d: Size %d, Jaccard %.4f, Dissolved %d times' % (i, populations[i], jaccard[i], dissolved[i]))
+
+    print('Consensus Labels: %.4f agree with k-means++, mean consensus index %.4f\n' % 
+        (agreement, np.mean(ck.consensus[1])))
 
     postclustering(args, ck, directory)
 
-def main():
+def gap(args, ck, directory):
+    preclustering(args, ck)
+
+    ks = list(range(args.kmin, args.kmax + 1))
+    cache = os.path.join(directory, args.cache) if args.cache else None
+
+    with TRACER.stage('Gap', ck.datapoints.shape[0]):
+        result = ck.gap(ks, args.references, args.n_init, args.processes, cache)
+
+    print('Gap Statistic (%d references):' % (args.references))
+
+    for _, r in result.iterrows():
+        print('k = %d: Gap %.4f, Standard Error %.4f' % (r['k'], r['gap'], r['standard error']))
+
+    # The smallest k whose gap is within a standard error of the gap of k + 1
+    gaps = result['gap'].values
+    errors = result['standard error'].values
+    chosen = [k for i, k in enumerate(ks[:-1]) if gaps[i] >= gaps[i + 1] - errors[i + 1]]
+
+    if chosen:
+        print('Suggested k: %d\n' % (chosen[0]))
+    else:
+        print('Suggested k: none up to %d\n' % (args.kmax))
+
+def search(args, ck, directory):
+    options = {'method': args.method, 
+               'pca': args.pca, 
+               'n_init': args.n_init, 
+               'samples': args.samples, 
+               'processes': args.processes, 
+               'cache': os.path.join(directory, args.cache) if args.cache else None}
+
+    if args.subsets:
+        subsets = []
+
+        for path in args.subsets:
+            with open(os.path.join(directory, path)) as f:
+                subsets.append(f.read().splitlines())
+
+        missing = sorted(set(c for s in subsets for c in s) - set(ck.columns))
+
+        if missing:
+            raise ValueError('Columns not in %s: %s' % (args.columns, ', '.join(missing)))
+
+        with TRACER.stage('Search', len(subsets)):
+            result = ck.score_subsets(subsets, args.k, **options)
+
+        print('Subset Scores (%s, k = %d):' % (args.method, args.k))
+
+        for path, (_, r) in zip(args.subsets, result.iterrows()):
+            print('%s: %d columns, Score %.4f%s' % (path, r['size'], r['score'], ' (cached)' if r['cached'] else ''))
+
+        scores = result['score'].values.astype(float)
+
+        if np.all(np.isnan(scores)):
+            print('No subset could be scored\n')
+            return
+
+        best = result['columns'].iloc[int(np.nanargmax(scores))]
+    else:
+        with TRACER.stage('Search', len(ck.columns)):
+            result = ck.select_subset(args.k, args.backward, args.steps, **options)
+
+        print('%s Search (%s, k = %d):' % ('Backward' if args.backward else 'Forward', args.method, args.k))
+
+        # A backward search starts by scoring all the columns, as step 0
+        for i, (_, r) in enumerate(result.iterrows(), 0 if args.backward else 1):
+            print('Step %d: %d columns, Score %.4f, %d clustered' % (i, r['size'], r['score'], r['clustered']))
+
+        if result.empty:
+            print('No subset could be scored\n')
+            return
+
+        best = result['columns'].iloc[-1]
+
+    print('Best Subset:\n%s\n' % ('\n'.join(best)))
+
+    if args.output:
+        with open(os.path.join(directory, args.output), 'w') as f:
+            f.write('\n'.join(best))
+
+def main(argv = None):
     directory = os.path.dirname(__file__)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('inputfile', help = 'Input file')
     parser.add_argument('columns', help = 'Input columns')
-    parser.add_argument('-scaler', help = 'Scaler', default = 'minmax')
+    parser.add_argument('-scaler', help = 'Scaler')
+    parser.add_argument('-trace', help = 'Save a trace of the stages')
+    store.add_arguments(parser)
 
     sp = parser.add_subparsers()
 
@@ -102,36 +366,117 @@ def main():
 
     cluster_parser = argparse.ArgumentParser(add_help = False)
     cluster_parser.add_argument('-pca', help = 'Apply PCA with n components', type = int)
+    cluster_parser.add_argument('-svd', help = 'Apply truncated SVD with n components', type = int)
     cluster_parser.add_argument('-loadings', help = 'Export the PCA component loadings')
     cluster_parser.add_argument('-export', nargs = 2, help = 'Export the processed dataset with labels')
 
+    # Silhouette diagrams do not cluster, so only the clustering commands embed their data
+    embed_parser = argparse.ArgumentParser(add_help = False)
+    embed_parser.add_argument('-tsne', help = 'Export a t-SNE embedding, cached in this folder')
+    embed_parser.add_argument('-perplexity', help = 't-SNE perplexity', type = float, default = 30)
+
     silhouette_parser = sp.add_parser('silhouette', help = 'View silhouette for a cluster assignment', parents = [cluster_parser])
     silhouette_parser.add_argument('k', help = 'Number of clusters assigned', type = int)
     silhouette_parser.add_argument('label', help = 'Cluster label')
     silhouette_parser.set_defaults(func = silhouette)
 
-    kmeans_parser = sp.add_parser('kmeans', help = 'Apply k-means', parents = [cluster_parser])
+    kmeans_parser = sp.add_parser('kmeans', help = 'Apply k-means', parents = [cluster_parser, embed_parser])
     kmeans_parser.add_argument('k', help = 'Number of clusters to assign', type = int)
     kmeans_parser.add_argument('-silhouette', help = 'View silhouette', action = 'store_true')
     kmeans_parser.set_defaults(func = kmeans)
 
-    args = parser.parse_args()
+    hdbscan_parser = sp.add_parser('hdbscan', help = 'Apply HDBSCAN', parents = [cluster_parser, embed_parser])
+    hdbscan_parser.add_argument('size', help = 'Smallest cluster size', type = int)
+    hdbscan_parser.add_argument('-min_samples', help = 'Neighbours of a dense point', type = int)
+    hdbscan_parser.add_argument('-tree', help = 'Neighbour tree', choices = ['kd', 'ball'], default = 'kd')
+    hdbscan_parser.set_defaults(func = hdbscan)
+
+    stability_parser = sp.add_parser('stability', help = 'Assess the stability of k-means', parents = [cluster_parser, embed_parser])
+    stability_parser.add_argument('k', help = 'Number of clusters to assign', type = int)
+    stability_parser.add_argument('-samples', help = 'Number of resamples', type = int, default = 100)
+    stability_parser.add_argument('-fraction', help = 'Size of each resample', type = float)
+    stability_parser.add_argument('-subsample', help = 'Resample without replacement', action = 'store_true')
+    stability_parser.add_argument('-processes', help = 'Number of processes', type = int)
+    stability_parser.set_defaults(func = stability)
+
+    gap_parser = sp.add_parser('gap', help = 'Compute the gap statistic of k-means')
+    gap_parser.add_argument('kmin', help = 'Smallest number of clusters', type = int)
+    gap_parser.add_argument('kmax', help = 'Largest number of clusters', type = int)
+    gap_parser.add_argument('-pca', help = 'Apply PCA with n components', type = int)
+    gap_parser.add_argument('-svd', help = 'Apply truncated SVD with n components', type = int)
+    gap_parser.add_argument('-references', help = 'Number of reference datasets', type = int, default = 10)
+    gap_parser.add_argument('-n_init', help = 'Number of initialisations of each fit', type = int, default = 3)
+    gap_parser.add_argument('-processes', help = 'Number of processes', type = int)
+    gap_parser.add_argument('-cache', help = 'Cache the fits in this file')
+    gap_parser.set_defaults(func = gap)
+
+    search_parser = sp.add_parser('search', help = 'Search for the best subset of the input columns')
+    search_parser.add_argument('k', help = 'Number of clusters to assign', type = int)
+    search_parser.add_argument('-method', help = 'Score of a subset', choices = ['silhouette', 'stability'], default = 'silhouette')
+    search_parser.add_argument('-subsets', help = 'Score these column files instead of searching', nargs = '+')
+    search_parser.add_argument('-backward', help = 'Remove columns instead of adding them', action = 'store_true')
+    search_parser.add_argument('-steps', help = 'Largest number of columns to add or remove', type = int)
+    search_parser.add_argument('-pca', help = 'Apply PCA with n components to each subset', type = int)
+    search_parser.add_argument('-n_init', help = 'Number of initialisations of each fit', type = int, default = 10)
+    search_parser.add_argument('-samples', help = 'Number of resamples for the stability score', type = int, default = 20)
+    search_parser.add_argument('-processes', help = 'Number of processes', type = int)
+    search_parser.add_argument('-cache', help = 'Cache the scores in this file')
+    search_parser.add_argument('-output', help = 'Save the best subset as a column file')
+    search_parser.set_defaults(func = search)
 
-    df = pd.read_csv(os.path.join(directory, args.inputfile))
+    args = parser.parse_args(argv)
+    occurrences = args.columns.endswith('.npz')
 
-    with open(os.path.join(directory, args.columns)) as f:
-        columns = f.read().splitlines()
+    if occurrences and (args.email or args.start or args.end):
+        parser.error('-email, -start and -end cannot be used with a food occurrence matrix')
 
-    ck = ClusterKit(df, columns)
+    if occurrences and args.func == search:
+        parser.error('search cannot be used with a food occurrence matrix')
+
+    if occurrences and args.func == gap and not args.svd:
+        parser.error('gap needs -svd to be used with a food occurrence matrix')
+
+    if args.trace:
+        TRACER.enable()
+
+    if occurrences:
+        # The columns of the matrix are the food ids listed alongside it
+        with open(os.path.join(os.path.dirname(os.path.join(directory, args.columns)), 'food_ids.txt')) as f:
+            columns = f.read().split('\n')
+
+        usecols = None
+    else:
+        with open(os.path.join(directory, args.columns)) as f:
+            columns = f.read().splitlines()
+
+        # Only the input features, and the labels of a silhouette diagram, are read
+        usecols = columns + ([args.label] if args.func == silhouette and args.label not in columns else [])
+
+    with TRACER.stage('Read Input') as stage:
+        df = store.read(os.path.join(directory, args.inputfile), args.table, args.email, args.start, args.end, usecols)
+        stage.rows = len(df.index)
+
+    if occurrences:
+        ck = ClusterKit(df, columns, sparse.load_npz(os.path.join(directory, args.columns)))
+    else:
+        ck = ClusterKit(df, columns)
 
     scalers = {'minmax': preprocessing.MinMaxScaler, 
                'standard': preprocessing.StandardScaler, 
-               'robust': preprocessing.RobustScaler}
+               'robust': preprocessing.RobustScaler,
+               'maxabs': preprocessing.MaxAbsScaler,
+               'tfidf': TfidfTransformer}
 
-    if scalers != 'none':
-        ck.scale(scalers[args.scaler])
+    scaler = args.scaler or ('tfidf' if occurrences else 'minmax')
+
+    if scaler != 'none':
+        with TRACER.stage('Scale', len(df.index)):
+            ck.scale(scalers[scaler])
 
     args.func(args, ck, directory)
 
+    if args.trace:
+        TRACER.save(os.path.join(directory, args.trace))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,10 +1,14 @@
 import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, HDBSCAN
 from sklearn.metrics import silhouette_samples, silhouette_score
-from sklearn.decomposition import PCA
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.manifold import TSNE
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+import hashlib
+import os
 
 
 '''
@@ -22,13 +26,20 @@ class ClusterKit:
         The dataframe containing all the data,
     columns : list
         A list of the names of the columns that are to be used as input features.
+    matrix : sparse matrix
+        If present, the input features are the columns of this matrix rather 
+        than those of the dataframe, and columns holds their names. Its rows 
+        must be those of the dataframe. It is never densified, so only 
+        sparse-aware scaling and dimensionality reduction (svd) can be used.
     '''
-    def __init__(self, data, columns):
+    def __init__(self, data, columns, matrix = None):
         self.rawdata = data
         self.columns = columns
-        self.datapoints = data[columns]
+        self.datapoints = data[columns] if matrix is None else matrix
         self.labels = None
         self.loadings = None
+        self.consensus = None
+        self.embedding = None
 
     '''
     Applies a scaling function to the dataset,
@@ -54,6 +65,33 @@ class ClusterKit:
         kmeans = KMeans(n_clusters = n, random_state = 0, n_init = 10, init = 'k-means++')
         self.labels = kmeans.fit_predict(self.datapoints)
 
+    '''
+    Applies HDBSCAN to the dataset, which finds clusters of any shape as 
+    regions of high density, without the number of clusters being chosen. 
+    Datapoints in regions of low density are left out of every cluster and 
+    labelled -1 as noise. The neighbours of each datapoint are found with a 
+    KD-tree or ball tree, so it takes O(n log n) time on low-dimensional 
+    (e.g. PCA-projected) data.
+
+    Parameters
+    ----------
+    size : integer
+        The smallest number of datapoints a cluster can have.
+    samples : integer
+        The number of neighbours a datapoint needs to be in a dense region. 
+        Larger values label more datapoints as noise. Defaults to size.
+    tree : string
+        The tree to find neighbours with, 'kd_tree' or 'ball_tree'. Sparse 
+        input features cannot be put in a tree, so their neighbours are 
+        found by brute force.
+    '''
+    def hdbscan(self, size, samples = None, tree = 'kd_tree'):
+        if sparse.issparse(self.datapoints):
+            tree = 'brute'
+
+        hdbscan = HDBSCAN(min_cluster_size = size, min_samples = samples, algorithm = tree, copy = True)
+        self.labels = hdbscan.fit_predict(self.datapoints)
+
     '''
     Displays a silhouette diagram for the current clustering.
 
@@ -68,11 +106,15 @@ class ClusterKit:
     http://scikit-learn.org/stable/auto_examples/cluster/plot_kmeans_silhouette_analysis.html#sphx-glr-auto-examples-cluster-plot-kmeans-silhouette-analysis-py
     '''
     def silhouette(self, n):
+        # matplotlib is only imported when it is needed, as it is slow to import
+        import matplotlib.pyplot as plt
+        import matplotlib.cm as cm
+
         silhouette_plot = plt.subplot(111)
         silhouette_plot.set_xlim([-0.1, 1])
         # The (n_clusters+1)*10 is for inserting blank space between silhouette
         # plots of individual clusters, to demarcate them clearly.
-        silhouette_plot.set_ylim([0, len(self.datapoints) + (n + 1)*10])
+        silhouette_plot.set_ylim([0, self.datapoints.shape[0] + (n + 1)*10])
 
         silhouette_avg = silhouette_score(self.datapoints, self.labels)
 
@@ -119,14 +161,35 @@ class ClusterKit:
     Retrieves the dataset with an additional column storing the cluster 
     assignment of each label.
 
+    If the input features are sparse, only the labels are exported.
+
+    If the stability of the clustering has been assessed, the consensus 
+    labels and their consensus indices are stored in two more columns. If 
+    it has been embedded, its t-SNE coordinates are stored in tsne 1 and 
+    tsne 2.
+
     Parameters
     ----------
     label : string
         The name of the column to store the cluster assignments under.
     '''
     def export(self, label):
-        result = pd.DataFrame(self.datapoints)
+        # Sparse input features are not exported, as they would have to be densified
+        if sparse.issparse(self.datapoints):
+            result = pd.DataFrame(index = np.arange(self.datapoints.shape[0]))
+        else:
+            result = pd.DataFrame(self.datapoints)
+
         result[label] = self.labels
+
+        if self.consensus is not None:
+            result[label + ' consensus'] = self.consensus[0]
+            result[label + ' consensus index'] = self.consensus[1]
+
+        if self.embedding is not None:
+            result['tsne 1'] = self.embedding[:, 0]
+            result['tsne 2'] = self.embedding[:, 1]
+
         return result
 
     '''
@@ -168,4 +231,488 @@ class ClusterKit:
         loadings = pca.components_.T * np.sqrt(pca.explained_variance_)
         loadings = pd.DataFrame(loadings, columns = list(range(n)))
         loadings['Feature'] = list(self.columns)
-        self.loadings = loadings[['Feature'] + list(loadings)[:-1]]
\ No newline at end of file
+        self.loadings = loadings[['Feature'] + list(loadings)[:-1]]
+
+    '''
+    Applies truncated SVD to the dataset. Unlike PCA, it does not centre 
+    the dataset, so it can be applied to sparse input features, e.g. food 
+    occurrences, without densifying them.
+
+    Parameters
+    ----------
+    n : integer
+        The number of SVD components to use.
+    '''
+    def svd(self, n):
+        svd = TruncatedSVD(n_components = n, random_state = 0)
+        self.datapoints = svd.fit_transform(self.datapoints)
+        loadings = pd.DataFrame(svd.components_.T, columns = list(range(n)))
+        loadings['Feature'] = list(self.columns)
+        self.loadings = loadings[['Feature'] + list(loadings)[:-1]]
+
+    '''
+    Assesses the stability of the current clustering by refitting k-means++ 
+    to resamples of the dataset on a pool of processes.
+
+    The stability of each cluster is its Jaccard similarity with the most 
+    similar cluster of each resample, averaged over the resamples. Values 
+    below 0.5 indicate that a cluster has dissolved.
+
+    The co-assignment matrix of the resamples is kept in factored form: it 
+    is the product of a sparse matrix of cluster memberships, with one 
+    column per resampled cluster, and its transpose. The consensus label 
+    of each datapoint is the cluster it is most often co-assigned with, 
+    which is found from the factors without forming the n x n matrix. Its 
+    consensus index is the proportion of co-assignments with that cluster.
+
+    Parameters
+    ----------
+    n : integer
+        The number of clusters.
+    samples : integer
+        The number of resamples.
+    fraction : float
+        The fraction of the dataset to draw in each resample. Defaults to 
+        1 for bootstraps and 0.8 for subsamples.
+    bootstrap : boolean
+        Whether to draw resamples with replacement, rather than subsamples 
+        without replacement.
+    processes : integer
+        The number of processes to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    jaccard : numpy array
+        The stability of each cluster.
+    dissolved : numpy array
+        The number of resamples in which each cluster dissolved.
+    '''
+    def stability(self, n, samples = 100, fraction = None, bootstrap = True, processes = None):
+        datapoints = self.datapoints if sparse.issparse(self.datapoints) else np.asarray(self.datapoints)
+        reference = np.asarray(self.labels)
+        size = datapoints.shape[0]
+        rng = np.random.RandomState(0)
+
+        if fraction is None:
+            fraction = 1.0 if bootstrap else 0.8
+
+        draws = [(np.sort(rng.choice(size, int(round(fraction*size)), replace = bootstrap)), seed) 
+                 for seed in range(samples)]
+
+        rows = []
+        cols = []
+        jaccard = np.zeros((samples, n))
+
+        with ProcessPoolExecutor(processes, initializer = _init_refit, initargs = (datapoints, reference, n)) as pool:
+            for b, (indices, labels, similarity) in enumerate(pool.map(_refit, draws)):
+                rows.append(indices)
+                cols.append(b*n + labels)
+                jaccard[b] = similarity
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+
+        # Memberships of each datapoint in the clusters of each resample, and in the resamples themselves
+        memberships = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape = (size, samples*n))
+        sampled = sparse.csr_matrix((np.ones(len(rows)), (rows, cols // n)), shape = (size, samples))
+        clusters = sparse.csr_matrix((np.ones(size), (np.arange(size), reference)), shape = (size, n))
+
+        # (memberships memberships^T) clusters, without forming memberships memberships^T
+        coassigned = memberships @ (memberships.T @ clusters).toarray()
+        cosampled = sampled @ (sampled.T @ clusters).toarray()
+
+        # A datapoint is not counted as being co-assigned with itself
+        times_sampled = np.asarray(sampled.sum(axis = 1)).ravel()
+        coassigned[np.arange(size), reference] -= times_sampled
+        cosampled[np.arange(size), reference] -= times_sampled
+        index = coassigned/np.maximum(cosampled, 1)
+
+        self.consensus = (index.argmax(axis = 1), index.max(axis = 1))
+
+        return np.nanmean(jaccard, axis = 0), (jaccard < 0.5).sum(axis = 0)
+
+    '''
+    Embeds the dataset in two dimensions with Barnes-Hut t-SNE, which takes
+    O(n log n) time, to view the clusters. The embedding does not depend on
+    the labels, so it can be cached by the contents of the dataset, and a
+    reclustering only recolours it.
+
+    Parameters
+    ----------
+    perplexity : float
+        The t-SNE perplexity, roughly the number of neighbours each
+        datapoint is attracted to.
+    cache : directory location
+        Location of the directory to cache the embeddings in. If absent,
+        nothing is cached.
+    '''
+    def embed(self, perplexity = 30, cache = None):
+        path = None
+
+        if cache:
+            path = os.path.join(cache, '%s-%g.npy' % (_fingerprint(self.datapoints), perplexity))
+
+            if os.path.exists(path):
+                self.embedding = np.load(path)
+                return
+
+        # PCA initialisation would densify sparse input features
+        init = 'random' if sparse.issparse(self.datapoints) else 'pca'
+        tsne = TSNE(n_components = 2, perplexity = perplexity, method = 'barnes_hut', init = init, random_state = 0)
+        self.embedding = tsne.fit_transform(self.datapoints)
+
+        if path:
+            os.makedirs(cache, exist_ok = True)
+            np.save(path, self.embedding)
+
+    '''
+    Computes the gap statistic of k-means++ for a range of cluster counts.
+
+    The reference datasets are drawn uniformly from the bounding box of the
+    dataset's principal components, and rotated back. Every reference is
+    clustered at every k, so the fits are spread over a pool of processes,
+    with fewer initialisations than kmeans uses.
+
+    The log of the within-cluster sum of squares of each fit can be cached
+    in a csv file, so that adding cluster counts or references only fits the
+    new ones.
+
+    Parameters
+    ----------
+    ks : list of integers
+        The numbers of clusters.
+    references : integer
+        The number of reference datasets.
+    n_init : integer
+        The number of k-means++ initialisations for each fit.
+    processes : integer
+        The number of processes to use. Defaults to the number of CPUs.
+    cache : file location
+        Location of the cache. If absent, nothing is cached.
+
+    Returns
+    -------
+    gap : dataframe
+        The gap and its standard error for each k, along with the log
+        within-cluster sum of squares of the dataset and its expectation
+        under the references.
+    '''
+    def gap(self, ks, references = 10, n_init = 3, processes = None, cache = None):
+        datapoints = np.asarray(self.datapoints, dtype = float)
+        dataset = _fingerprint(datapoints)
+
+        columns = ['dataset', 'n_init', 'k', 'reference', 'log W']
+        fits = pd.DataFrame(columns = columns)
+
+        if cache and os.path.exists(cache):
+            fits = pd.read_csv(cache, dtype = {'dataset': str})
+
+        current = fits[(fits['dataset'] == dataset) & (fits['n_init'] == n_init)]
+        done = set(zip(current['k'], current['reference']))
+
+        # Reference -1 is the dataset itself
+        tasks = [(k, b) for k in ks for b in range(-1, references) if (k, b) not in done]
+
+        if tasks:
+            mean = datapoints.mean(axis = 0)
+            rotation = np.linalg.svd(datapoints - mean, full_matrices = False)[2].T
+            rotated = (datapoints - mean) @ rotation
+            box = (mean, rotation, rotated.min(axis = 0), rotated.max(axis = 0))
+
+            with ProcessPoolExecutor(processes, initializer = _init_gap, initargs = (datapoints, box, n_init)) as pool:
+                new = pd.DataFrame([(dataset, n_init, k, b, w) for (k, b), w in zip(tasks, pool.map(_fit_gap, tasks))],
+                                   columns = columns)
+
+            fits = pd.concat([fits, new], ignore_index = True)
+            current = pd.concat([current, new], ignore_index = True)
+
+            if cache:
+                fits.to_csv(cache, index = False)
+
+        current = current[current['k'].isin(ks) & (current['reference'] < references)]
+        observed = current[current['reference'] == -1].groupby('k')['log W'].first()
+        expected = current[current['reference'] >= 0].groupby('k')['log W']
+
+        result = pd.DataFrame({'log W': observed, 'expected log W': expected.mean()})
+        result['gap'] = result['expected log W'] - result['log W']
+        result['standard error'] = expected.std(ddof = 0)*np.sqrt(1 + 1.0/references)
+
+        return result.rename_axis('k').reset_index()
+
+    '''
+    Scores subsets of the input features by clustering each of them with 
+    k-means++ on a pool of processes. Every scaler is applied column by 
+    column, so the dataset is scaled once and each subset is a selection of 
+    its columns, which is sent to each process only once.
+
+    The score of each subset can be cached in a csv file, keyed by a hash 
+    of its scaled columns and the scoring options, so that a search can be 
+    resumed or extended without clustering the same subset again.
+
+    Parameters
+    ----------
+    subsets : list of lists
+        The names of the columns in each subset.
+    k : integer
+        The number of clusters.
+    method : string
+        How each clustering is scored: 'silhouette' for its mean silhouette 
+        coefficient, or 'stability' for the mean Jaccard stability of its 
+        clusters over bootstrap refits.
+    pca : integer
+        If present, the number of PCA components each subset is reduced to 
+        before clustering, or its number of columns if that is smaller.
+    n_init : integer
+        The number of k-means++ initialisations for each fit.
+    samples : integer
+        The number of bootstrap refits for the stability method.
+    processes : integer
+        The number of processes to use. Defaults to the number of CPUs.
+    cache : file location
+        Location of the cache. If absent, nothing is cached.
+
+    Returns
+    -------
+    scores : dataframe
+        The columns, size and score of each subset, in the order given, and 
+        whether its score was cached.
+    '''
+    def score_subsets(self, subsets, k, method = 'silhouette', pca = None, n_init = 10, samples = 20, 
+                      processes = None, cache = None):
+        datapoints = np.asarray(self.datapoints, dtype = float)
+        positions = {c: i for i, c in enumerate(self.columns)}
+
+        # Subsets are kept in the order of the input features, so the same subset always has the same hash
+        subsets = [sorted(set(s), key = positions.__getitem__) for s in subsets]
+        indices = [[positions[c] for c in s] for s in subsets]
+        keys = [_fingerprint(datapoints[:, i]) for i in indices]
+
+        columns = ['subset', 'method', 'k', 'pca', 'n_init', 'samples', 'score', 'columns']
+        scores = pd.DataFrame(columns = columns)
+
+        if cache and os.path.exists(cache):
+            scores = pd.read_csv(cache, dtype = {'subset': str})
+
+        options = (method, k, pca or 0, n_init, samples if method == 'stability' else 0)
+        current = scores[(scores[columns[1:6]] == pd.Series(options, index = columns[1:6])).all(axis = 1)]
+        done = dict(zip(current['subset'], current['score']))
+
+        tasks = list(dict.fromkeys(key for key in keys if key not in done))
+
+        if tasks:
+            first = dict(zip(keys, indices))
+
+            with ProcessPoolExecutor(processes, initializer = _init_subsets, 
+                                     initargs = (datapoints, k, method, pca, n_init, samples)) as pool:
+                new = list(pool.map(_score_subset, [first[key] for key in tasks]))
+
+            named = dict(zip(keys, subsets))
+            new = pd.DataFrame([(key, ) + options + (score, ';'.join(named[key])) for key, score in zip(tasks, new)], 
+                               columns = columns)
+            done.update(zip(new['subset'], new['score']))
+
+            if cache:
+                pd.concat([scores, new], ignore_index = True).to_csv(cache, index = False)
+
+        return pd.DataFrame({'columns': subsets, 
+                             'size': [len(s) for s in subsets], 
+                             'score': [done[key] for key in keys], 
+                             'cached': [key not in tasks for key in keys]})
+
+    '''
+    Searches for the subset of the input features with the best score, by 
+    greedily adding (forward) or removing (backward) one column at a time, 
+    for as long as it improves the score. The candidates of each step are 
+    scored in parallel by score_subsets, and cached by it.
+
+    Parameters
+    ----------
+    k : integer
+        The number of clusters.
+    backward : boolean
+        Whether to start from all the columns and remove them, rather than 
+        start from none and add them.
+    steps : integer
+        If present, the largest number of columns to add or remove.
+    **options :
+        The other parameters of score_subsets.
+
+    Returns
+    -------
+    path : dataframe
+        The columns, size and score of the best subset of each step, 
+        starting with all the columns for a backward search, and the 
+        number of candidates that had to be clustered.
+    '''
+    def select_subset(self, k, backward = False, steps = None, **options):
+        columns = list(self.columns)
+        selected = list(columns) if backward else []
+        best = -np.inf
+        path = []
+
+        if backward:
+            scores = self.score_subsets([selected], k, **options)
+            best = scores['score'].iloc[0]
+            path.append((list(selected), len(selected), best, int((~scores['cached']).sum())))
+
+        while steps is None or len(path) - int(backward) < steps:
+            if backward:
+                candidates = [[c for c in selected if c != r] for r in selected] if len(selected) > 1 else []
+            else:
+                candidates = [selected + [c] for c in columns if c not in selected]
+
+            if not candidates:
+                break
+
+            scores = self.score_subsets(candidates, k, **options)
+            values = scores['score'].values.astype(float)
+
+            if np.all(np.isnan(values)) or np.nanmax(values) <= best:
+                break
+
+            i = int(np.nanargmax(values))
+            selected = scores['columns'].iloc[i]
+            best = values[i]
+            path.append((list(selected), len(selected), best, int((~scores['cached']).sum())))
+
+        return pd.DataFrame(path, columns = ['columns', 'size', 'score', 'clustered'])
+
+'''
+Prepares a worker process of the stability pool, so that the dataset is
+only sent to each process once.
+'''
+def _init_refit(datapoints, reference, n):
+    global _datapoints, _reference, _n
+    _datapoints = datapoints
+    _reference = reference
+    _n = n
+
+    # Each process already runs in parallel, so k-means++ is limited to a single thread
+    threadpool_limits(1)
+
+'''
+Refits k-means++ to a resample and compares it to the reference clustering.
+
+Returns
+-------
+indices : numpy array
+    The distinct datapoints of the resample.
+labels : numpy array
+    The labels of the distinct datapoints.
+similarity : numpy array
+    The Jaccard similarity of each reference cluster with its most similar 
+    cluster in the resample, or NaN if none of its datapoints were drawn.
+'''
+def _refit(draw):
+    sample, seed = draw
+
+    return _jaccard(_datapoints, _reference, _n, sample, seed)
+
+'''
+Refits k-means++ to a resample of a dataset and compares it to a reference 
+clustering, as for _refit.
+'''
+def _jaccard(datapoints, reference, n, sample, seed, n_init = 10):
+    kmeans = KMeans(n_clusters = n, random_state = seed, n_init = n_init, init = 'k-means++')
+    kmeans.fit(datapoints[sample])
+
+    indices = np.unique(sample)
+    labels = kmeans.predict(datapoints[indices])
+
+    # The contingency table of the reference clusters against the resampled clusters
+    contingency = np.bincount(reference[indices]*n + labels, minlength = n*n).reshape(n, n)
+    union = contingency.sum(axis = 1)[:, None] + contingency.sum(axis = 0)[None, :] - contingency
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        similarity = (contingency/union).max(axis = 1)
+
+    similarity[contingency.sum(axis = 1) == 0] = np.nan
+
+    return indices, labels, similarity
+
+'''
+Prepares a worker process of the gap statistic pool.
+'''
+def _init_gap(datapoints, box, n_init):
+    global _datapoints, _box, _n_init
+    _datapoints = datapoints
+    _box = box
+    _n_init = n_init
+
+    threadpool_limits(1)
+
+'''
+Fits k-means++ to the dataset, or to a reference dataset, and retrieves
+the log of its within-cluster sum of squares. Each reference is drawn
+with its own seed, so that it is the same whichever process draws it.
+'''
+def _fit_gap(task):
+    k, b = task
+    datapoints = _datapoints
+
+    if b >= 0:
+        mean, rotation, lower, upper = _box
+        rng = np.random.RandomState(b)
+        datapoints = rng.uniform(lower, upper, (len(_datapoints), len(lower))) @ rotation.T + mean
+
+    kmeans = KMeans(n_clusters = k, random_state = 0, n_init = _n_init, init = 'k-means++')
+    kmeans.fit(datapoints)
+
+    return np.log(kmeans.inertia_)
+
+'''
+Prepares a worker process of the subset scoring pool.
+'''
+def _init_subsets(datapoints, k, method, pca, n_init, samples):
+    global _datapoints, _k, _method, _pca, _n_init, _samples
+    _datapoints = datapoints
+    _k = k
+    _method = method
+    _pca = pca
+    _n_init = n_init
+    _samples = samples
+
+    threadpool_limits(1)
+
+'''
+Clusters a subset of the columns of the dataset with k-means++ and scores 
+the clustering, or returns NaN if it has fewer than two clusters.
+'''
+def _score_subset(indices):
+    datapoints = _datapoints[:, indices]
+
+    if _pca:
+        datapoints = PCA(n_components = min(_pca, len(indices))).fit_transform(datapoints)
+
+    kmeans = KMeans(n_clusters = _k, random_state = 0, n_init = _n_init, init = 'k-means++')
+    labels = kmeans.fit_predict(datapoints)
+
+    if len(np.unique(labels)) < 2:
+        return np.nan
+
+    if _method == 'silhouette':
+        return silhouette_score(datapoints, labels)
+
+    # The mean Jaccard stability of the clusters over bootstraps of the subset
+    rng = np.random.RandomState(0)
+    similarities = [_jaccard(datapoints, labels, _k, np.sort(rng.choice(len(labels), len(labels))), seed, _n_init)[2]
+                    for seed in range(_samples)]
+
+    return np.nanmean(similarities)
+
+'''
+Retrieves a hash of the contents of a dataset, which may be sparse.
+'''
+def _fingerprint(datapoints):
+    if sparse.issparse(datapoints):
+        datapoints = datapoints.tocsr()
+        arrays = [datapoints.data, datapoints.indices, datapoints.indptr, np.array(datapoints.shape)]
+    else:
+        arrays = [np.asarray(datapoints, dtype = float)]
+
+    digest = hashlib.sha1()
+
+    for a in arrays:
+        digest.update(np.ascontiguousarray(a).tobytes())
+
+    return digest.hexdigest()
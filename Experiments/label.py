@@ -1,26 +1,39 @@
-import pandas as pd
 import argparse
+import sys
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from tracing import TRACER
+import store
+
 '''
-A simple script to append the cluster labels from one csv file to another.
+A simple script to append the cluster labels from one data file to another.
+Data files may be in csv, Parquet (.parquet) or Feather (.feather) format.
 
 Parameters
 ----------
 datafile : file location
-    Location of the file to apply the labels to.
+    Location of the file to apply the labels to. It may also be an SQLite 
+    database written by global_preprocessing.py.
+table, email, start, end :
+    As for cluster_analysis.py. These must match the options the labels 
+    were produced with.
 labelfile : file location
     Location of the file to extract the labels to.
 incol : string
     The name of the column that stores the cluster labels in the 
     label file.
 outpuftfolder : file location
-    The path to where the newly labeled data file should be saved.
+    The path to where the newly labeled data file should be saved. Its 
+    format is given by its extension.
 outcol : string
     The name of the column that will encode the cluster labels in the 
     newly labeled data file.
+trace : file location
+    If present, a trace of the time and memory used by each stage is 
+    saved to this file.
 '''
-def main():
+def main(argv = None):
     directory = os.path.dirname(__file__)
 
     parser = argparse.ArgumentParser()
@@ -29,12 +42,26 @@ def main():
     parser.add_argument('incol', help = 'Input label column')
     parser.add_argument('outputfile', help = 'Output file')
     parser.add_argument('outcol', help = 'Output label file')
+    parser.add_argument('-trace', help = 'Save a trace of the stages')
+    store.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        TRACER.enable()
+
+    with TRACER.stage('Read Data') as stage:
+        data = store.read(os.path.join(directory, args.datafile), args.table, args.email, args.start, args.end)
+        stage.rows = len(data.index)
+
+    with TRACER.stage('Read Labels', len(data.index)):
+        data[args.incol] = store.read(os.path.join(directory, args.labelfile), columns = [args.outcol])[args.outcol]
 
-    args = parser.parse_args()
+    with TRACER.stage('Write Output', len(data.index)):
+        store.save(data, os.path.join(directory, args.outputfile))
 
-    data = pd.read_csv(os.path.join(directory, args.datafile))
-    data[args.incol] = pd.read_csv(os.path.join(directory, args.labelfile))[args.outcol]
-    data.to_csv(os.path.join(directory, args.outputfile), index = False)
+    if args.trace:
+        TRACER.save(os.path.join(directory, args.trace))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,8 +4,13 @@ from collections import Counter
 import matplotlib.pyplot as plt
 import seaborn as sns
 import argparse
+import sys
 import os
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from tracing import TRACER
+import store
+
 '''
 A script to plot the tabulated results of a clustering experiment.
 Each plot has a corresponding tabulated summary.
@@ -13,7 +18,12 @@ Each plot has a corresponding tabulated summary.
 Parameters
 ----------
 inputfile : file location
-    Location of the clustering results.
+    Location of the clustering results, in csv, Parquet (.parquet) or 
+    Feather (.feather) format. Only the plotted columns are read from it. 
+    It may also be an SQLite database written by global_preprocessing.py, 
+    to plot the data without clusters.
+table, email, start, end :
+    As for cluster_analysis.py.
 bar_columns : file location
     Location of a file listing the columns to be output as bar plots 
     with each column on a new line.
@@ -21,13 +31,35 @@ box_columns : file location
     Location of a file listing the columns to be output as box plots 
     with each column on a new line.
 cluster_column : string
-    The name of the column that encodes the cluster labels. If absent, 
+    The name of the column that encodes the cluster labels. The label -1 
+    is noise, e.g. from HDBSCAN, and is plotted as its own group. If absent, 
     this script will output the general plots of the input file as a whole
     as if it were a single cluster.
+scatter : list of strings
+    The names of two columns to draw a scatter plot of, coloured by 
+    cluster, e.g. the t-SNE coordinates tsne 1 and tsne 2 exported by 
+    cluster_analysis.py.
+bootstrap : integer
+    If present, the number of resamples of each cluster to compute
+    bootstrap confidence intervals from. The intervals of the mean,
+    standard deviation, quartiles and median of each box plot column, and
+    of the proportion of each value of each bar plot column, are added to
+    their summaries.
+confidence : float
+    The confidence level of the intervals.
+memory : integer
+    The memory, in MB, that the resamples drawn at once may take, along 
+    with every buffer used to summarise them. As many resamples of a 
+    cluster as fit in it are drawn together, so a larger budget is faster 
+    for small clusters. The data itself and the statistics of all the 
+    resamples (40 bytes per box plot column and resample) come on top.
 outputfolder : directory location
     Location of the directory to place all the plots and summaries.
+trace : file location
+    If present, a trace of the time and memory used by each stage is 
+    saved to this file.
 '''
-def main():
+def main(argv = None):
     directory = os.path.dirname(__file__)
 
     parser = argparse.ArgumentParser()
@@ -35,15 +67,18 @@ def main():
     parser.add_argument('-bar_columns', help = 'Bar plot output columns')
     parser.add_argument('-box_columns', help = 'Box plot output columns')
     parser.add_argument('-cluster_column', help = 'Cluster column')
+    parser.add_argument('-scatter', help = 'Scatter plot columns', nargs = 2)
+    parser.add_argument('-bootstrap', help = 'Number of resamples for confidence intervals', type = int)
+    parser.add_argument('-confidence', help = 'Confidence level', type = float, default = 0.95)
+    parser.add_argument('-memory', help = 'Memory for each batch of resamples and its buffers, in MB', type = int, default = 256)
     parser.add_argument('outputfolder', help = 'Output folder')
+    parser.add_argument('-trace', help = 'Save a trace of the stages')
+    store.add_arguments(parser)
 
-    args = parser.parse_args()
-
-    data = pd.read_csv(open(os.path.join(directory, args.inputfile)))
+    args = parser.parse_args(argv)
 
-    if not args.cluster_column:
-        data['cluster'] = 0
-        args.cluster_column = 'cluster'
+    if args.trace:
+        TRACER.enable()
 
     box_columns = []
     bar_columns = []
@@ -56,43 +91,80 @@ def main():
         with open(os.path.join(directory, args.bar_columns)) as f:
             bar_columns = f.read().splitlines()
 
+    # Only the columns that are plotted are read
+    usecols = box_columns + bar_columns + (args.scatter or []) + ([args.cluster_column] if args.cluster_column else [])
+    usecols = list(dict.fromkeys(usecols)) or None
+
+    with TRACER.stage('Read Input') as stage:
+        data = store.read(os.path.join(directory, args.inputfile), args.table, args.email, args.start, args.end, usecols)
+        stage.rows = len(data.index)
+
+    if not args.cluster_column:
+        data['cluster'] = 0
+        args.cluster_column = 'cluster'
+
     labels = np.unique(data[args.cluster_column].values)
     labels.sort()
 
     destination = args.outputfolder + ('/%s plot.%s')
 
+    bootstrap = None
+
+    if args.bootstrap:
+        bootstrap = (args.bootstrap, args.memory*2**20, args.confidence, np.random.RandomState(0))
+
     # Create the population plot
-    populations = data[args.cluster_column].value_counts(sort = False).sort_index().values
-    plt.bar(labels, populations)
-    plt.xticks(labels)
-    plt.savefig(os.path.join(directory, destination % ('population', 'png')))
-    plt.close()
+    with TRACER.stage('Population Plot', len(data.index)):
+        populations = data[args.cluster_column].value_counts(sort = False).sort_index().values
+        plt.bar(labels, populations)
+        plt.xticks(labels)
+        plt.savefig(os.path.join(directory, destination % ('population', 'png')))
+        plt.close()
+
+        tlabels = [str(l) for l in labels]
 
-    tlabels = [str(l) for l in labels]
+        # Create the population summary
+        with open(os.path.join(directory, destination % ('population', 'csv')), 'w+') as f:
+            f.write('cluster,%s\n' % (','.join(tlabels)))
+            f.write('%s,%s\n' % ('count', ','.join(populations.astype(str))))
 
-    # Create the population summary
-    with open(os.path.join(directory, destination % ('population', 'csv')), 'w+') as f:
-        f.write('cluster,%s\n' % (','.join(tlabels)))
-        f.write('%s,%s\n' % ('count', ','.join(populations.astype(str))))
+    # Create the scatter plot
+    if args.scatter:
+        with TRACER.stage('Scatter Plot', len(data.index)):
+            scatterplot(args.scatter, args.cluster_column, data, labels, directory, destination)
 
     # Create the bar plots
-    for c in bar_columns:
-        barplot(c, args.cluster_column, data, labels, directory, destination)
+    with TRACER.stage('Bar Plots', len(data.index)):
+        for c in bar_columns:
+            barplot(c, args.cluster_column, data, labels, directory, destination, bootstrap)
+
+    # The confidence intervals of all the box plot columns of each cluster are bootstrapped together
+    intervals = None
+
+    if bootstrap and box_columns:
+        with TRACER.stage('Bootstrap', len(data.index)):
+            intervals = np.stack([box_intervals(data.loc[data[args.cluster_column] == l, box_columns].values.astype(float), bootstrap)
+                                  for l in labels])
 
     # Create the box plots
-    with open(os.path.join(directory, destination % ('summary', 'csv')), 'w+') as f:
-        f.write('cluster,%s\n' % (','.join(tlabels)))
+    with TRACER.stage('Box Plots', len(data.index)):
+        with open(os.path.join(directory, destination % ('summary', 'csv')), 'w+') as f:
+            f.write('cluster,%s\n' % (','.join(tlabels)))
+
+            for j, c in enumerate(box_columns):
+                cluster_data = []
 
-        for c in box_columns:
-            cluster_data = []
+                for l in labels:
+                    cluster_data.append(data[data[args.cluster_column] == l][c])
 
-            for l in labels:
-                cluster_data.append(data[data[args.cluster_column] == l][c])
+                # Create a summary file for all the box plot columns
+                summary = boxplot(c, cluster_data, labels, directory, destination, 
+                                  None if intervals is None else (intervals[:, :, j], args.confidence))
+                f.write('%s,%s\n' % (''.join(c.split(',')),
+                        ','.join(['%s (%s)' % (summary[0][i], summary[1][i]) for i in range(len(labels))])))
 
-            # Create a summary file for all the box plot columns
-            summary = boxplot(c, cluster_data, labels, directory, destination)
-            f.write('%s,%s\n' % (''.join(c.split(',')),
-                    ','.join(['%s (%s)' % (summary[0][i], summary[1][i]) for i in range(len(labels))])))
+    if args.trace:
+        TRACER.save(os.path.join(directory, args.trace))
 
 '''
 Creates and exports a boxplot and boxplot summary of the clusters for a given column.
@@ -109,13 +181,18 @@ directory : string
     The output directory.
 directory : string
     The destination filename template.
+intervals : tuple
+    If present, the bootstrap confidence intervals of the mean, standard 
+    deviation, quartiles and median of each cluster, as returned by 
+    box_intervals, and their confidence level. Their bounds are added to 
+    the summary.
 
 Returns
 -------
 table : list of lists
     A list of the means and standard deviations for each cluster.
 '''
-def boxplot(column, data, labels, directory, destination):
+def boxplot(column, data, labels, directory, destination, intervals = None):
     # Produce the plot
     fig, ax = plt.subplots(1)
 
@@ -124,20 +201,21 @@ def boxplot(column, data, labels, directory, destination):
 
     table = [[None for _ in range(len(labels))] for _ in range(7)]
 
-    # Extract details from the plot's graphing parameters to place into the summary file
-    for l in labels:
-        table[0][l] = format(np.mean(data[l].values))
-        table[1][l] = format(np.std(data[l].values))
+    # Extract details from the plot's graphing parameters to place into the summary file.
+    # Clusters are indexed by position, as the labels need not start at 0, e.g. the noise label -1
+    for i in range(len(labels)):
+        table[0][i] = format(np.mean(data[i].values))
+        table[1][i] = format(np.std(data[i].values))
 
-        lower = results['whiskers'][2*l].get_ydata()
-        table[2][l] = format(lower[1])
-        table[3][l] = format(lower[0])
+        lower = results['whiskers'][2*i].get_ydata()
+        table[2][i] = format(lower[1])
+        table[3][i] = format(lower[0])
 
-        table[4][l] = format(results['medians'][l].get_ydata()[0])
+        table[4][i] = format(results['medians'][i].get_ydata()[0])
 
-        upper = results['whiskers'][2*l + 1].get_ydata()
-        table[5][l] = format(upper[0])
-        table[6][l] = format(upper[1])
+        upper = results['whiskers'][2*i + 1].get_ydata()
+        table[5][i] = format(upper[0])
+        table[6][i] = format(upper[1])
 
     plt.savefig(os.path.join(directory, destination % (column, 'png')))
     plt.close()
@@ -152,8 +230,59 @@ def boxplot(column, data, labels, directory, destination):
         for i in range(len(rows)):
             f.write('%s,%s\n' % (rows[i], ','.join(table[i])))
 
+        if intervals is not None:
+            bounds, confidence = intervals
+            statistics = ['Mean', 'Standard Deviation', 'First Quartile', 'Median', 'Third Quartile']
+
+            for i in range(len(statistics)):
+                for b, bound in enumerate(['lower', 'upper']):
+                    f.write('%s (%g%% CI %s),%s\n' % (statistics[i], 100*confidence, bound, 
+                            ','.join(format(x) for x in bounds[:, i, b])))
+
     return table[0:2]
 
+'''
+Creates and exports a scatter plot of two columns, coloured by cluster.
+
+Parameters
+----------
+columns : list
+    Names of the two columns.
+cluster : string
+    Name of the cluster column.
+data : dataframe
+    The dataframe of the clustering results.
+labels : array_like
+    A structure containing the names of the clusters.
+directory : string
+    The output directory.
+destination : string
+    The destination filename template.
+'''
+def scatterplot(columns, cluster, data, labels, directory, destination):
+    fig, ax = plt.subplots(1)
+    cmap = plt.get_cmap('tab10')
+
+    for i, l in enumerate(labels):
+        points = data[data[cluster] == l]
+
+        # Noise is drawn in grey, behind the clusters
+        if l == -1:
+            ax.scatter(points[columns[0]], points[columns[1]], s = 4, alpha = 0.4, 
+                       color = 'lightgrey', label = 'noise', zorder = 0)
+        else:
+            ax.scatter(points[columns[0]], points[columns[1]], s = 4, alpha = 0.7, 
+                       color = cmap(i % 10), label = str(l))
+
+    ax.set_xlabel(columns[0])
+    ax.set_ylabel(columns[1])
+
+    if len(labels) > 1:
+        ax.legend(title = 'cluster', markerscale = 3)
+
+    plt.savefig(os.path.join(directory, destination % ('scatter', 'png')))
+    plt.close()
+
 '''
 Creates and exports a barplot and barplot summary of the clusters for a given column.
 
@@ -169,8 +298,11 @@ directory : string
     The output directory.
 directory : string
     The destination filename template.
+bootstrap : tuple
+    If present, the options of bar_intervals. The bounds of the confidence 
+    interval of each proportion are added to the summary.
 '''
-def barplot(column, cluster, data, labels, directory, destination):
+def barplot(column, cluster, data, labels, directory, destination, bootstrap = None):
     counts = []
 
     for l in labels:
@@ -201,8 +333,142 @@ def barplot(column, cluster, data, labels, directory, destination):
     for l in labels:
         counts[l] = counts[l].apply(format)
 
+    if bootstrap:
+        confidence = bootstrap[2]
+
+        for l in labels:
+            codes = pd.Index(values).get_indexer(data.loc[data[cluster] == l, column])
+            bounds = bar_intervals(codes, len(values), bootstrap)
+
+            for b, bound in enumerate(['lower', 'upper']):
+                counts['%s (%g%% CI %s)' % (l, 100*confidence, bound)] = [format(x) for x in bounds[:, b]]
+
     counts.to_csv(os.path.join(directory, destination % (column, 'csv')), index = False)
 
+'''
+Computes bootstrap confidence intervals of the box plot statistics of a 
+cluster, for every box plot column at once. The indices of each batch of 
+resamples are drawn as one array, and the batches are as large as the 
+memory budget allows for the size of the cluster. The indices are sorted 
+and the deviations from the mean squared in place, so a batch only holds 
+its indices, its resamples and their statistics.
+
+The indices are drawn into the sorted values of each column, so once they 
+are sorted, which is done once for all the columns, the quartiles of every 
+resample are read off at fixed positions rather than found by sorting the 
+resamples. Each column is thus resampled on its own, which does not change 
+its intervals.
+
+Parameters
+----------
+values : numpy array
+    The values of the box plot columns in the cluster, with a row for 
+    each datapoint and a column for each box plot column. They are 
+    sorted in place.
+bootstrap : tuple
+    The number of resamples, the memory budget of each batch in bytes, 
+    the confidence level and the random state to draw them with.
+
+Returns
+-------
+intervals : numpy array
+    The lower and upper bounds of the mean, standard deviation, first 
+    quartile, median and third quartile of each column, with shape 
+    (5, columns, 2).
+'''
+def box_intervals(values, bootstrap):
+    replicates, memory, confidence, rng = bootstrap
+    n, columns = values.shape
+    values.sort(axis = 0)
+
+    # Each resample holds its indices, the values of every column and their 5 statistics, 8 bytes each
+    batch = max(1, memory//(8*(n*(columns + 1) + 5*columns)))
+    statistics = []
+
+    # The positions of the quartiles in a sorted resample, interpolated linearly as by np.percentile
+    positions = np.array([0.25, 0.5, 0.75])*(n - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, n - 1)
+    fractions = (positions - lower)[:, None, None]
+
+    for start in range(0, replicates, batch):
+        indices = rng.randint(0, n, (min(batch, replicates - start), n))
+        indices.sort(axis = 1)
+        samples = values[indices]
+        del indices
+
+        below = np.moveaxis(samples[:, lower], 1, 0)
+        above = np.moveaxis(samples[:, upper], 1, 0)
+        quartiles = below + fractions*(above - below)
+
+        # The standard deviation is taken as np.std does, but without a copy of the resamples
+        means = samples.mean(axis = 1, keepdims = True)
+        samples -= means
+        np.multiply(samples, samples, out = samples)
+        deviations = np.sqrt(samples.mean(axis = 1))
+
+        # The resamples are released before the next batch is drawn
+        del samples
+
+        statistics.append(np.stack([means[:, 0], deviations] + list(quartiles)))
+
+    return interval(np.concatenate(statistics, axis = 1), confidence, 1)
+
+'''
+Computes bootstrap confidence intervals of the proportion of each value of 
+a bar plot column in a cluster. The proportions of each batch of resamples 
+are counted with a single bincount, and the batches are as large as the 
+memory budget allows. The codes of a batch are offset in place, so it only 
+holds its indices, their codes and its counts.
+
+Parameters
+----------
+codes : numpy array
+    The position of each datapoint's value in the list of values, or -1 
+    if it is missing.
+m : integer
+    The number of values.
+bootstrap : tuple
+    As for box_intervals.
+
+Returns
+-------
+intervals : numpy array
+    The lower and upper bounds of the proportion of each value, with shape 
+    (m, 2).
+'''
+def bar_intervals(codes, m, bootstrap):
+    replicates, memory, confidence, rng = bootstrap
+    n = len(codes)
+    proportions = []
+
+    # Each resample holds its indices and their codes, and its counts and proportions, 8 bytes each
+    batch = max(1, memory//(16*(n + m + 1)))
+
+    # Missing values are counted in an extra bin, as the proportions are of the values that are present
+    codes = np.where(codes < 0, m, codes)
+
+    for start in range(0, replicates, batch):
+        b = min(batch, replicates - start)
+        samples = codes[rng.randint(0, n, (b, n))]
+        samples += (m + 1)*np.arange(b)[:, None]
+        counts = np.bincount(samples.ravel(), minlength = b*(m + 1)).reshape(b, m + 1)[:, :m]
+        del samples
+
+        with np.errstate(invalid = 'ignore'):
+            proportions.append(counts/counts.sum(axis = 1, keepdims = True))
+
+    return interval(np.concatenate(proportions), confidence, 0)
+
+'''
+Retrieves the percentile intervals of bootstrapped statistics, whose 
+resamples are along the given axis. The bounds are along the last axis.
+'''
+def interval(statistics, confidence, axis):
+    alpha = (1 - confidence)/2
+
+    return np.moveaxis(np.nanpercentile(statistics, [100*alpha, 100*(1 - alpha)], axis = axis), 0, -1)
+
 def format(x):
     return '%.4f' % (round(x, 4))
 
@@ -0,0 +1,303 @@
+import importlib
+import socketserver
+import contextlib
+import subprocess
+import traceback
+import argparse
+import socket
+import stat
+import tempfile
+import shlex
+import json
+import sys
+import io
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from tracing import TRACER
+import store
+
+'''
+A script to run the commands of the experiment shell scripts in a single
+long-lived session, rather than starting a new interpreter for each one.
+The modules a command needs are imported when it is first run and are
+then kept, and so are the data files it reads, until they change.
+
+Commands of cluster_analysis.py, label.py, plot.py and agreement.py are
+run in the session. The other commands of the shell scripts, i.e.
+global_preprocessing.py, adc.py, md.py, rni.py and cluster_analysis.r,
+are run in their own processes, without a shell. Lines that are not one
+of these commands are refused.
+
+A resident session listens on a Unix socket that only its user can
+connect to. By default it is kept in $XDG_RUNTIME_DIR, or otherwise in a
+directory of the user's own in the temporary directory, so that no one
+else can take its place.
+
+Batch Parameters
+----------------
+scripts : list of file locations
+    The shell scripts to run, e.g. Raw/Key/cluster.sh Raw/Key/label.sh.
+    Each is run from its own directory, as if it were run by bash.
+
+Serve Parameters
+----------------
+socket : file location
+    The Unix socket to listen on. Defaults to one in $XDG_RUNTIME_DIR,
+    or in a directory of the user's own in the temporary directory.
+
+Send Parameters
+---------------
+scripts : list of file locations
+    The shell scripts for the session listening on the socket to run.
+socket : file location
+    The Unix socket the session listens on.
+
+Stop Parameters
+---------------
+socket : file location
+    The Unix socket the session listens on.
+'''
+
+SCRIPTS = ['cluster_analysis', 'label', 'plot', 'agreement']
+
+# The commands run in their own processes, by interpreter
+COMMANDS = {'python': ['global_preprocessing', 'adc', 'md', 'rni'],
+            'Rscript': ['cluster_analysis']}
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+# The directory of the default socket, which only its user may use
+RUNTIME = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), 'dietary_patterns_%d' % (os.getuid()))
+
+SOCKET = os.path.join(RUNTIME, 'dietary_patterns_session.sock')
+
+'''
+Runs a line of a shell script.
+
+Parameters
+----------
+line : string
+    The line, e.g. python3 ../../plot.py Raw/Key/raw_clusters.csv ...
+cwd : directory location
+    The directory the line is run from.
+
+Returns
+-------
+status : integer
+    The exit status of the command.
+'''
+def run(line, cwd):
+    argv = shlex.split(line, comments = True)
+
+    if not argv:
+        return 0
+
+    interpreter = 'python' if os.path.basename(argv[0]).startswith('python') else os.path.basename(argv[0])
+    script = os.path.realpath(os.path.join(cwd, argv[1])) if len(argv) > 1 else ''
+    name = os.path.splitext(os.path.basename(script))[0]
+
+    if interpreter == 'python' and name in SCRIPTS and os.path.dirname(script) == os.path.join(ROOT, 'Experiments'):
+        return run_script(name, argv[2:])
+
+    if name not in COMMANDS.get(interpreter, []) or not script.startswith(ROOT + os.sep):
+        print('%s is not a command of the experiments' % (line))
+        return 1
+
+    # The arguments are passed as they are, so nothing in the line is interpreted by a shell
+    program = sys.executable if interpreter == 'python' else interpreter
+    result = subprocess.run([program, script] + argv[2:], cwd = cwd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    print(result.stdout.decode(), end = '')
+
+    return result.returncode
+
+'''
+Runs a script in the session, with the given arguments.
+'''
+def run_script(name, argv):
+    try:
+        importlib.import_module(name).main(argv)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        traceback.print_exc(file = sys.stdout)
+        return 1
+    finally:
+        # A traced command must not leave tracing on for the next one
+        TRACER.disable()
+
+    return 0
+
+'''
+Runs every line of a number of shell scripts, stopping at the first one
+that fails.
+'''
+def run_scripts(scripts, cwd):
+    for script in scripts:
+        path = os.path.join(cwd, script)
+
+        if not os.path.isfile(path):
+            print('%s does not exist' % (script))
+            return 1
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+        for line in lines:
+            status = run(line, os.path.dirname(path))
+
+            if status != 0:
+                print('%s failed with status %d' % (line, status))
+                return status
+
+    return 0
+
+class Handler(socketserver.StreamRequestHandler):
+    '''
+    Runs the scripts sent by a client, streaming their output back to it
+    and ending with their exit status.
+    '''
+    def handle(self):
+        line = self.rfile.readline()
+
+        # A connection that sends nothing only checks that the session is listening
+        if not line:
+            return
+
+        message = json.loads(line.decode())
+
+        if message.get('stop'):
+            self.server.stopped = True
+            return
+
+        output = io.TextIOWrapper(self.wfile, write_through = True)
+
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            status = run_scripts(message['scripts'], message['cwd'])
+
+        output.write('\n%d\n' % (status))
+        output.detach()
+
+class Server(socketserver.UnixStreamServer):
+    pass
+
+def batch(args):
+    store.enable_cache()
+    sys.exit(run_scripts(args.scripts, os.getcwd()))
+
+def serve(args):
+    store.enable_cache()
+
+    if os.path.dirname(os.path.abspath(args.socket)) == os.path.abspath(RUNTIME):
+        private_directory(RUNTIME)
+
+    if os.path.lexists(args.socket):
+        info = os.lstat(args.socket)
+
+        # Anything else in the way is left alone, as it may not be ours to remove
+        if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+            print('%s is not a socket of this user' % (args.socket))
+            sys.exit(1)
+
+        try:
+            connect(args.socket).close()
+            print('A session is already listening on %s' % (args.socket))
+            sys.exit(1)
+        except ConnectionRefusedError:
+            # Left behind by a session that did not stop
+            os.remove(args.socket)
+
+    # The socket is created readable and writable by its user only
+    umask = os.umask(0o177)
+
+    try:
+        server = Server(args.socket, Handler)
+    finally:
+        os.umask(umask)
+
+    # Commands are run one at a time, as the scripts share the tracer and matplotlib's state
+    with server:
+        server.stopped = False
+        print('Session listening on %s' % (args.socket))
+
+        try:
+            while not server.stopped:
+                server.handle_request()
+        finally:
+            os.remove(args.socket)
+
+'''
+Creates the directory of the default socket if it does not exist, and
+checks that it belongs to the user and that no one else can use it.
+'''
+def private_directory(directory):
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(directory, 0o700)
+
+    info = os.lstat(directory)
+
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        print('%s is not a directory that only this user can use' % (directory))
+        sys.exit(1)
+
+def send(args):
+    response = request({'scripts': [os.path.abspath(s) for s in args.scripts], 'cwd': os.getcwd()}, args.socket)
+
+    output, _, status = response.rstrip('\n').rpartition('\n')
+    print(output, end = '')
+    sys.exit(int(status))
+
+def stop(args):
+    request({'stop': True}, args.socket)
+
+def connect(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        raise
+
+    return connection
+
+def request(message, path):
+    try:
+        connection = connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print('No session is listening on %s' % (path))
+        sys.exit(1)
+
+    with connection:
+        connection.sendall((json.dumps(message) + '\n').encode())
+
+        with connection.makefile('r') as f:
+            return f.read()
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    sp = parser.add_subparsers()
+
+    batch_parser = sp.add_parser('batch', help = 'Run shell scripts in a session')
+    batch_parser.add_argument('scripts', help = 'Shell scripts', nargs = '+')
+    batch_parser.set_defaults(func = batch)
+
+    serve_parser = sp.add_parser('serve', help = 'Start a session that runs the shell scripts sent to it')
+    serve_parser.add_argument('-socket', help = 'Unix socket', default = SOCKET)
+    serve_parser.set_defaults(func = serve)
+
+    send_parser = sp.add_parser('send', help = 'Send shell scripts to a session')
+    send_parser.add_argument('scripts', help = 'Shell scripts', nargs = '+')
+    send_parser.add_argument('-socket', help = 'Unix socket', default = SOCKET)
+    send_parser.set_defaults(func = send)
+
+    stop_parser = sp.add_parser('stop', help = 'Stop a session')
+    stop_parser.add_argument('-socket', help = 'Unix socket', default = SOCKET)
+    stop_parser.set_defaults(func = stop)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
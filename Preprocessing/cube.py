@@ -0,0 +1,156 @@
+import pandas as pd
+import numpy as np
+import argparse
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+import store
+
+'''
+The aggregation cube holds additive aggregates of the meal items at the
+finest level that any of the aggregations needs: one cell per meal (the
+subject, day and foodtype) and kind of item, where the kinds are solid,
+liquid (other than water) and water. The day, meal, subject and any other
+aggregations are roll-ups of the cube, so they never have to go back to
+the meal items.
+
+The cube only holds the keys of its cells and their additive measures. The
+attributes of the subjects and days depend on the email and date alone, so
+they are joined to a roll-up rather than repeated in every cell.
+
+When run as a script, it rolls up the cube saved by global_preprocessing.py.
+
+Parameters
+----------
+cubefile : file location
+    Location of the cube, i.e. Data/meal_cube.csv (or .parquet or .feather).
+outputfile : file location
+    The path to where the roll-up should be saved. Its format is given by
+    its extension.
+by : list of strings
+    The columns to roll the cube up by, e.g. email foodtype, which are
+    among the keys of the cube (email, date, foodtype and kind). The week
+    column may also be used, which holds the first day of the week of
+    each date.
+kinds : list of strings
+    The kinds of items to include. Defaults to all of them.
+'''
+
+KINDS = ['solid', 'liquid', 'water']
+
+# The columns identifying a cell of the cube
+KEYS = ['email', 'date', 'foodtype', 'kind']
+
+'''
+Builds the cube from the meal items.
+
+Parameters
+----------
+items : dataframe
+    The meal items, with the is liquid and is water columns.
+keys : list
+    The columns identifying a meal, i.e. email, date and foodtype. Items
+    with a missing foodtype are kept in a meal of their own.
+results : dictionary
+    The aggregation of each column, all of which must be re-aggregatable,
+    e.g. 'sum' or 'max'.
+
+Returns
+-------
+cube : dataframe
+    The cube, ordered by its keys, with a kind column, an items column 
+    counting the items of each cell, and a foodName column joining the 
+    names of its items.
+names : dataframe
+    The names of all the items of each meal, in the order they were
+    recorded. These cannot be rebuilt from the cells, as the items of
+    different kinds are interleaved.
+'''
+def build_cube(items, keys, results):
+    # The cells of a meal are ordered by the name of their kind
+    kinds = np.array(sorted(KINDS))
+    codes = np.searchsorted(kinds, np.select([~items['is liquid'].astype(bool), items['is water'].astype(bool)], 
+                                             KINDS[0::2], KINDS[1]))
+
+    # The items are only grouped by their keys once, and each meal is split into its cells by kind
+    meals = items.groupby(keys, dropna = False).ngroup().values
+    cells = meals*len(kinds) + codes
+
+    grouped = items.groupby(cells)
+    cell_codes, first = np.unique(cells, return_index = True)
+
+    cube = items[keys].iloc[first].reset_index(drop = True)
+    cube['kind'] = kinds[cell_codes % len(kinds)]
+    cube['items'] = grouped.size().values
+    cube = pd.concat([cube, grouped.agg(results).reset_index(drop = True)], axis = 1)
+    cube['foodName'] = join_names(items['foodName'], cells)
+
+    first = np.unique(meals, return_index = True)[1]
+    names = items[keys].iloc[first].reset_index(drop = True)
+    names['foodName'] = join_names(items['foodName'], meals)
+
+    return cube, names
+
+'''
+Joins the names of the items of each group with semicolons, in the order
+the items were recorded, for the groups in the order of their codes. The
+items are sorted by group once, so each group is a slice of the names.
+'''
+def join_names(names, groups):
+    order = np.argsort(groups, kind = 'mergesort')
+    names = names.values[order].tolist()
+    bounds = (np.flatnonzero(np.diff(groups[order])) + 1).tolist()
+
+    return [';'.join(names[start:end]) for start, end in zip([0] + bounds, bounds + [len(names)])]
+
+'''
+Rolls the cube (or a roll-up of it) up to a coarser level.
+
+Parameters
+----------
+cube : dataframe
+    The cube.
+by : list
+    The columns to group by.
+results : dictionary
+    The aggregation of each column. The columns of the cube are
+    additive, so they are summed. Columns of the cube that are not
+    aggregated, such as the dimensions, can be counted with
+    pd.Series.nunique, e.g. the number of distinct days.
+kinds : list
+    The kinds of items to include, or None to include all of them.
+'''
+def rollup(cube, by, results, kinds = None):
+    if kinds is not None:
+        cube = cube[cube['kind'].isin(kinds)]
+
+    return cube.groupby(by, as_index = False).agg(results)
+
+def main():
+    directory = os.path.dirname(__file__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cubefile', help = 'Cube file')
+    parser.add_argument('outputfile', help = 'Output file')
+    parser.add_argument('-by', help = 'Columns to roll up by', nargs = '+', required = True)
+    parser.add_argument('-kinds', help = 'Kinds of items', nargs = '+', choices = KINDS)
+
+    args = parser.parse_args()
+
+    cube = store.read(os.path.join(directory, args.cubefile))
+
+    if 'week' in args.by:
+        cube['week'] = pd.to_datetime(cube['date']).dt.to_period('W').dt.start_time.dt.strftime('%Y-%m-%d')
+
+    results = {c: 'sum' for c in cube.columns if c not in KEYS and c != 'week'}
+
+    # The number of distinct subjects, days and foodtypes in each roll-up
+    for c in ['email', 'date', 'foodtype']:
+        if c not in args.by:
+            results[c] = pd.Series.nunique
+
+    store.save(rollup(cube, args.by, results, args.kinds), os.path.join(directory, args.outputfile))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,19 @@
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import argparse
+import sys
 import os
 import copy
+import io
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from tracing import TRACER
+import store
+from cube import build_cube, rollup
+from occurrence import food_ids, occurrence_matrix
 
 # One of the column deletion operation triggers a false positive for SettingWithCopyWarning
 pd.options.mode.chained_assignment = None
@@ -17,6 +29,9 @@ with open('questionnaire_columns.txt') as f:
 with open('survey_columns.txt') as f:
     SURVEY_COLUMNS = f.read().splitlines()
 
+# The columns describing a subject once their BMI has been added
+SUBJECT_COLUMNS = SURVEY_COLUMNS + ['bmi']
+
 with open('grouping_columns.txt') as f:
     GROUPING_COLUMNS = f.read().splitlines()
 
@@ -54,152 +69,498 @@ AGGREGATION_COLUMNS = {'total': 'sum',
                        'Monounsaturated fat (g)': 'sum',
                        'Polyunsaturated fat (g)': 'sum'}
 
+# The number of days covered by each rolling window
+WINDOW_DAYS = 7
+
+# The kinds of items (see cube.py) included in each meal-level aggregation
+MEAL_KINDS = {'Solid': ['solid'],
+              'Liquid': ['liquid']}
+
 MANUAL_DISCARDS = ["Nachos Vegetables with Guac, Guzman Y Gomez ",
                    "Moroccan lamb, Sumo Salad"]
 
 def main():
-    directory = os.path.dirname(__file__)
-
-    # Processing the survey dataset
-    surveys_file = os.path.join(directory, os.pardir, 'Data/surveys.csv')
-    surveys = pd.read_csv(surveys_file, usecols = SURVEY_COLUMNS)
-    surveys['email'] = surveys['email'].str.lower()
-    surveys = discard_unknown_gender(surveys)
-    surveys = discard_erroneous_measurements(surveys)
-    surveys = discard_survey_clashes(surveys)
-
-    for c in SURVEY_COLUMNS:
-        surveys[c].fillna(-1, inplace = True)
-
-    for c in RECOMMENDATIONS:
-        surveys[c] = surveys.apply(apply_serving_guidelines, serving = c, axis = 1)
-
-    surveys['bmi'] = surveys['weight']/np.square(surveys['height']/100.0)
-    SURVEY_COLUMNS.append('bmi')
-
-    # Processing the questionnaires dataset
-    questionnaires_file = os.path.join(directory, os.pardir, 'Data/questionnaires.csv')
-    questionnaires = pd.read_csv(questionnaires_file, usecols = QUESTIONNAIRE_COLUMNS)
-    questionnaires = questionnaires.drop_duplicates()
-    questionnaires['username'] = questionnaires['username'].str.lower()
-    questionnaires['q3_check_6_answer'].fillna('', inplace = True)
-    questionnaires['q3_check_6_answer'] = questionnaires['q3_check_6_answer'].apply(lambda x: x != '')
-    questionnaires = discard_questionnaire_clashes(questionnaires)
-
-    # Preprocessing the meals dataset
-    meals_file = os.path.join(directory, os.pardir, 'Data/meals.xlsx')
-    meals = pd.read_excel(meals_file, dtype = {'date': str})
-    meals['username'] = meals['username'].str.lower()
-    meals['date'] = meals['date'].apply(lambda time: time.split(' ')[0])
-    meals = mark_for_discard(meals)
-    meals = discard_duplicate_items(meals)
-    
-    liquids_file = os.path.join(directory, os.pardir, 'Data/liquids.csv')
-    liquids = pd.read_csv(liquids_file, usecols = LIQUID_COLUMNS)
-    meals = meals.merge(liquids, left_on = 'foodName', right_on = 'foodName', how = 'inner')
-    meals['drinks'] = np.where(meals['is liquid'], meals['total'], 0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-data', help = 'Data folder', default = os.path.join(os.path.dirname(__file__), os.pardir, 'Data'))
+    parser.add_argument('-trace', help = 'Save a trace of the stages')
+    parser.add_argument('-database', help = 'Also store the outputs in this SQLite database')
+    parser.add_argument('-format', help = 'Format of the outputs', choices = ['csv', 'parquet', 'feather'], default = 'csv')
+    parser.add_argument('-shards', help = 'Number of shards of the subjects to process in parallel', type = int, default = 1)
 
-    # Combining the datasets
-    combination = surveys.merge(questionnaires, left_on = 'email', right_on = 'username', how = 'inner')
-    combination = combination.merge(meals, left_on = ['email', 'date'], right_on = ['username', 'date'], how = 'inner')
+    args = parser.parse_args()
 
-    for c in AGGREGATION_COLUMNS:
-        combination[c].fillna(0, inplace = True)
-    
-    # Day-level combination
-    day_agg = day_aggregation(combination)
-    day_agg['bmr'] = day_agg.apply(bmr, axis = 1)
-    day_agg['bmr multiplier'] = day_agg['Energy, with dietary fibre (kJ)']/day_agg['bmr']
-    day_agg = apply_lower_multiplier_threshold(day_agg)
-    day_agg = apply_upper_multiplier_threshold(day_agg)
-    day_agg = discard_marked(day_agg)
-    day_agg = discard_insufficient_entries(day_agg)
+    if args.trace:
+        TRACER.enable()
 
-    # Meal-level aggregation
-    meal_agg = meal_aggregation(combination, day_agg[['email', 'date']], 'Full')
-    meal_agg_solid = meal_aggregation(combination[~combination['is liquid']], day_agg[['email', 'date']], 'Solid')
-    meal_agg_liquid = meal_aggregation(combination[combination['is liquid'] & ~combination['is water']], day_agg[['email', 'date']], 'Liquid')
+    directory = args.data
+    audit = []
 
-    # Subject-level aggregation
-    subject_agg = subject_aggregation(day_agg)
+    # Shards beyond the number of CPUs could not run at once, and would only repeat the fixed costs of every step
+    shards = min(args.shards, os.cpu_count())
 
-    day_agg_file = os.path.join(directory, os.pardir, 'Data/day_aggregation.csv')
-    day_agg.to_csv(day_agg_file, index = False)
+    if shards < args.shards:
+        print('Reducing the shards to %d, the number of CPUs\n' % shards)
 
-    meal_agg_file = os.path.join(directory, os.pardir, 'Data/meal_aggregation.csv')
-    meal_agg.to_csv(meal_agg_file, index = False)
+    if shards > 1:
+        tables = shard(directory, shards, audit)
+    else:
+        # The datasets are independent until they are combined, so each is loaded and cleaned in its own process
+        if os.cpu_count() > 1:
+            with ProcessPoolExecutor(3) as pool:
+                surveys = pool.submit(ingest, process_surveys, directory, TRACER.enabled)
+                questionnaires = pool.submit(ingest, process_questionnaires, directory, TRACER.enabled)
+                meals = pool.submit(ingest, process_meals, directory, TRACER.enabled)
+
+                surveys = collect(surveys, audit)
+                questionnaires = collect(questionnaires, audit)
+                meals = collect(meals, audit)
+        else:
+            # With a single CPU the processes could only take turns, and passing the datasets back would cost more than it saves
+            surveys = process_surveys(directory, audit)
+            questionnaires = process_questionnaires(directory, audit)
+            meals = process_meals(directory, audit)
+
+        tables = aggregate(surveys, questionnaires, meals, audit)
+
+    day_agg = tables['day']
+    meal_agg = tables['meal']
+    meal_agg_solid = tables['meal solid']
+    meal_agg_liquid = tables['meal liquid']
+    subject_agg = tables['subject']
+    week_agg = tables['week']
+    cube = tables['cube']
+
+    # The rolling means are differences of running sums over the whole table, so they are computed on all the subjects at once
+    with TRACER.stage('Rolling Aggregation') as stage:
+        rolling_agg = rolling_aggregation(day_agg)
+        stage.rows = len(rolling_agg.index)
+
+    # Food occurrences of each day and subject
+    with TRACER.stage('Food Occurrences') as stage:
+        items = tables['items']
+        foods = food_ids(items)
+        day_foods = occurrence_matrix(items, day_agg[['email', 'date']], foods)
+        subject_foods = occurrence_matrix(items, subject_agg[['email']], foods)
+        stage.rows = day_foods.nnz
+
+    with TRACER.stage('Write Outputs'):
+        store.save(day_agg, os.path.join(directory, 'day_aggregation.' + args.format))
+        store.save(meal_agg, os.path.join(directory, 'meal_aggregation.' + args.format))
+        store.save(meal_agg_solid, os.path.join(directory, 'meal_aggregation_solid.' + args.format))
+        store.save(meal_agg_liquid, os.path.join(directory, 'meal_aggregation_liquid.' + args.format))
+        store.save(subject_agg, os.path.join(directory, 'subject_aggregation.' + args.format))
+        store.save(rolling_agg, os.path.join(directory, 'rolling_aggregation.' + args.format))
+        store.save(week_agg, os.path.join(directory, 'week_aggregation.' + args.format))
+
+        # The rows of the occurrence matrices are those of day_aggregation.csv and subject_aggregation.csv
+        sparse.save_npz(os.path.join(directory, 'day_foods.npz'), day_foods)
+        sparse.save_npz(os.path.join(directory, 'subject_foods.npz'), subject_foods)
+
+        with open(os.path.join(directory, 'food_ids.txt'), 'w') as f:
+            f.write('\n'.join(foods))
+
+        cube = cube.drop(columns = ['manual discard', 'foodName'])
+        store.save(cube, os.path.join(directory, 'meal_cube.' + args.format))
+
+    if args.database:
+        with TRACER.stage('Write Database'):
+            store.write(args.database, {'day_aggregation': day_agg,
+                                        'meal_aggregation': meal_agg,
+                                        'meal_aggregation_solid': meal_agg_solid,
+                                        'meal_aggregation_liquid': meal_agg_liquid,
+                                        'subject_aggregation': subject_agg,
+                                        'rolling_aggregation': rolling_agg,
+                                        'week_aggregation': week_agg,
+                                        'meal_cube': cube})
+
+    audit = pd.DataFrame(audit)
+    print('Cleaning Audit:\n%s\n' % (audit.to_string(index = False)))
+
+    audit_file = os.path.join(directory, 'cleaning_audit.csv')
+    audit.to_csv(audit_file, index = False)
+
+    if args.trace:
+        TRACER.save(args.trace)
+
+'''
+Cleaning rules take the table and the mask of rows that survived the
+preceding rules, and return a mask of the rows that pass the rule. Rules
+that look across rows (e.g. clashes) only consider the surviving rows, so
+that a sequence of rules behaves exactly like a sequence of filters.
+'''
+def apply_rules(df, table, subject, rules, audit):
+    keep = pd.Series(True, index = df.index)
+    subjects = df[subject].nunique()
+
+    for rule in rules:
+        passed = keep & rule(df, keep)
+        remaining_subjects = df[subject].where(passed).nunique()
+
+        audit.append({'table': table,
+                      'rule': rule.__name__,
+                      'rows before': int(keep.sum()),
+                      'rows removed': int(keep.sum() - passed.sum()),
+                      'subjects before': subjects,
+                      'subjects removed': subjects - remaining_subjects})
+
+        keep = passed
+        subjects = remaining_subjects
+
+    # The table is only filtered once, after all the rules have been evaluated
+    return df[keep].reset_index(drop = True)
+
+'''
+Loads a dataset in a worker process, tracing it if the main process is
+traced and returning its cleaning audit and stages along with it.
+'''
+def ingest(process, directory, trace):
+    if trace:
+        TRACER.enable()
+
+    audit = []
+    df = process(directory, audit)
+
+    return df, audit, TRACER.events
+
+'''
+Waits for a dataset loaded by ingest, adding its audit and stages to those
+of the main process.
+'''
+def collect(future, audit):
+    df, entries, events = future.result()
+    audit += entries
+    TRACER.extend(events)
 
-    meal_agg_solid_file = os.path.join(directory, os.pardir, 'Data/meal_aggregation_solid.csv')
-    meal_agg_solid.to_csv(meal_agg_solid_file, index = False)
+    return df
 
-    meal_agg_liquid_file = os.path.join(directory, os.pardir, 'Data/meal_aggregation_liquid.csv')
-    meal_agg_liquid.to_csv(meal_agg_liquid_file, index = False)
+'''
+Combines the cleaned datasets and aggregates them, from the meal-level cube
+up to the subjects. Every step is keyed by subject, so the datasets may
+hold any subset of the subjects, e.g. a shard.
+
+Returns
+-------
+tables : dictionary
+    The day, meal (full, solid and liquid), subject and week aggregations,
+    the cube, and the meal items of the days that were kept.
+'''
+def aggregate(surveys, questionnaires, meals, audit):
+    # Combining the datasets
+    with TRACER.stage('Merge Datasets') as stage:
+        # The attributes of a subject and day are kept apart from the items, as they only depend on the email and date.
+        # Days with a missing attribute are left out, as grouping by the attributes would do
+        days = surveys.merge(questionnaires, left_on = 'email', right_on = 'username', how = 'inner')[GROUPING_COLUMNS]
+        days = days.dropna().drop_duplicates(['email', 'date'])
 
-    subject_agg_file = os.path.join(directory, os.pardir, 'Data/subject_aggregation.csv')
-    subject_agg.to_csv(subject_agg_file, index = False)
+        combination = meals.merge(days[['email', 'date']], left_on = ['username', 'date'], right_on = ['email', 'date'], how = 'inner')
 
-def discard_unknown_gender(surveys):
-    initial_subjects = len(surveys.index)
+        for c in AGGREGATION_COLUMNS:
+            combination[c].fillna(0, inplace = True)
 
-    surveys = surveys[surveys['gender'] != 3]
+        stage.rows = len(combination.index)
 
-    remaining_subjects = len(surveys.index)
+    # Meal-level aggregates, from which every other aggregation is rolled up
+    with TRACER.stage('Build Cube') as stage:
+        cube, names = meal_cube(combination)
+        stage.rows = len(cube.index)
 
-    print('Discarding Subjects with Unknown Genders:\nSurvey Subjects: %d -> %d\n' % 
-        (initial_subjects, remaining_subjects))
+    # Day-level combination
+    with TRACER.stage('Day Aggregation') as stage:
+        day_agg = day_aggregation(cube, days)
+        stage.rows = len(day_agg.index)
+
+    with TRACER.stage('Clean Days') as stage:
+        day_agg['bmr'] = bmr(day_agg)
+        day_agg['bmr multiplier'] = day_agg['Energy, with dietary fibre (kJ)']/day_agg['bmr']
+        day_agg = apply_rules(day_agg, 'day_agg', 'email', 
+            [apply_lower_multiplier_threshold, apply_upper_multiplier_threshold, discard_marked, 
+             discard_insufficient_entries], audit)
+        day_agg = day_agg.drop(columns = ['manual discard'])
+        stage.rows = len(day_agg.index)
+
+    # Meal-level aggregation
+    with TRACER.stage('Meal Aggregation') as stage:
+        meal_agg = meal_aggregation(cube, names, day_agg[GROUPING_COLUMNS], 'Full')
+        meal_agg_solid = meal_aggregation(cube, names, day_agg[GROUPING_COLUMNS], 'Solid')
+        meal_agg_liquid = meal_aggregation(cube, names, day_agg[GROUPING_COLUMNS], 'Liquid')
+        cube = cube.merge(day_agg[['email', 'date']], left_on = ['email', 'date'], right_on = ['email', 'date'], how = 'inner')
+        stage.rows = len(meal_agg.index)
+
+    # Subject-level aggregation
+    with TRACER.stage('Subject Aggregation') as stage:
+        subject_agg = subject_aggregation(day_agg)
+        stage.rows = len(subject_agg.index)
+
+    # Multi-day aggregation
+    with TRACER.stage('Week Aggregation') as stage:
+        week_agg = week_aggregation(day_agg)
+        stage.rows = len(week_agg.index)
+
+    items = combination[['email', 'date', 'foodName']].merge(day_agg[['email', 'date']], on = ['email', 'date'], how = 'inner')
+
+    return {'day': day_agg,
+            'meal': meal_agg,
+            'meal solid': meal_agg_solid,
+            'meal liquid': meal_agg_liquid,
+            'subject': subject_agg,
+            'week': week_agg,
+            'cube': cube,
+            'items': items}
+
+'''
+Runs the whole of the cleaning and aggregation on a number of shards of the
+subjects in parallel, and combines their results as if they had been
+produced at once. Subjects are assigned to shards by a hash of their
+(lowercased) email, so the shards are the same from run to run.
+
+The input files are read, parsed and hashed once, the meals in this
+process while the surveys and questionnaires are read in their own, and
+split into the shards before these are handed to the processes that
+clean and aggregate them. There are at most as many shards as CPUs.
+
+Every aggregation is ordered by email before anything else, and a subject
+is never split across shards, so sorting the concatenated shards by email
+(with a stable sort) restores the order of an unsharded run exactly.
+
+Parameters
+----------
+directory : directory location
+    Location of the data folder.
+shards : integer
+    The number of shards.
+audit : list
+    The cleaning audit, to which the entries of all the shards are added.
+
+Returns
+-------
+tables : dictionary
+    As for aggregate.
+'''
+def shard(directory, shards, audit):
+    with ProcessPoolExecutor(2) as pool:
+        surveys = pool.submit(partition, read_surveys, directory, 'email', shards, TRACER.enabled)
+        questionnaires = pool.submit(partition, read_questionnaires, directory, 'username', shards, TRACER.enabled)
+
+        # The meals are by far the largest dataset, so they are read here rather than passed back from a worker
+        meals = split_shards(read_meals(directory), 'username', shards)
+        liquids = read_liquids(directory)
+
+        surveys = collect(surveys, audit)
+        questionnaires = collect(questionnaires, audit)
+
+    with ProcessPoolExecutor(min(shards, os.cpu_count())) as pool:
+        futures = [pool.submit(process_shard, (i, shards), surveys[i], questionnaires[i], meals[i], liquids, TRACER.enabled)
+                   for i in range(shards)]
+        results = []
+
+        # The shards are collected in order, so the log and trace do not depend on which finishes first
+        for future in futures:
+            tables, entries, events, log = future.result()
+            TRACER.extend(events)
+            print(log, end = '')
+            results.append((tables, entries))
+
+    with TRACER.stage('Combine Shards') as stage:
+        tables = {}
+
+        for name in results[0][0]:
+            # Empty shards are left out, as their columns may not have the types of the others
+            frames = [t[name] for t, _ in results if len(t[name].index)] or [results[0][0][name]]
+            df = pd.concat(frames, ignore_index = True)
+
+            if name != 'items':
+                df = df.sort_values('email', kind = 'mergesort').reset_index(drop = True)
+
+            tables[name] = df
+
+        # The subjects of the shards are disjoint, so the counts of each rule add up
+        entries = pd.DataFrame([e for _, shard_entries in results for e in shard_entries])
+        audit += entries.groupby(['table', 'rule'], sort = False, as_index = False).sum().to_dict('records')
+
+        stage.rows = len(tables['day'].index)
+
+    return tables
+
+'''
+Reads a dataset in a worker process and splits it into shards, returning
+them with the stages of the worker in the form that collect expects.
+'''
+def partition(read, directory, column, shards, trace):
+    if trace:
+        TRACER.enable()
+
+    return split_shards(read(directory), column, shards), [], TRACER.events
+
+'''
+Cleans and aggregates a shard of the subjects in a worker process,
+returning its tables, cleaning audit, stages and log.
+'''
+def process_shard(shard, surveys, questionnaires, meals, liquids, trace):
+    if trace:
+        TRACER.enable()
+
+    audit = []
+    log = io.StringIO()
+
+    with contextlib.redirect_stdout(log):
+        print('Shard %d of %d:\n' % (shard[0] + 1, shard[1]))
+
+        surveys = clean_surveys(surveys, audit)
+        questionnaires = clean_questionnaires(questionnaires, audit)
+        meals = clean_meals(meals, liquids, audit)
+        tables = aggregate(surveys, questionnaires, meals, audit)
+
+    return tables, audit, TRACER.events, log.getvalue()
+
+'''
+Splits a dataset into shards of its subjects.
+
+Parameters
+----------
+df : dataframe
+    The dataset.
+column : string
+    The column that identifies the subjects, i.e. email or username.
+shards : integer
+    The number of shards.
+
+Returns
+-------
+shards : list of dataframes
+    The rows of the subjects of each shard.
+'''
+def split_shards(df, column, shards):
+    codes = pd.util.hash_pandas_object(df[column].str.lower(), index = False).values % shards
+
+    return [df[codes == i].reset_index(drop = True) for i in range(shards)]
+
+'''
+Loads and cleans the survey dataset.
+'''
+def process_surveys(directory, audit):
+    return clean_surveys(read_surveys(directory), audit)
+
+def read_surveys(directory):
+    with TRACER.stage('Read Surveys') as stage:
+        surveys_file = os.path.join(directory, 'surveys.csv')
+        surveys = pd.read_csv(surveys_file, usecols = SURVEY_COLUMNS)
+        stage.rows = len(surveys.index)
 
     return surveys
 
-def discard_survey_clashes(surveys):
-    initial_subjects = len(surveys.index)
+def clean_surveys(surveys, audit):
+    with TRACER.stage('Clean Surveys') as stage:
+        surveys['email'] = surveys['email'].str.lower()
+        surveys = apply_rules(surveys, 'surveys', 'email', 
+            [discard_unknown_gender, discard_erroneous_measurements, discard_survey_clashes], audit)
 
-    surveys = surveys.drop_duplicates(subset = ['email'], keep = False)
+        for c in SURVEY_COLUMNS:
+            surveys[c].fillna(-1, inplace = True)
 
-    remaining_subjects = len(surveys.index)
+        for c in RECOMMENDATIONS:
+            surveys[c] = apply_serving_guidelines(surveys, c)
 
-    print('Discarding Subjects with Survey Clashes:\nSurvey Subjects: %d -> %d\n' % 
-        (initial_subjects, remaining_subjects))
+        surveys['bmi'] = surveys['weight']/np.square(surveys['height']/100.0)
+        stage.rows = len(surveys.index)
 
     return surveys
 
-def discard_erroneous_measurements(surveys):
-    initial_subjects = len(surveys.index)
+'''
+Loads and cleans the questionnaires dataset.
+'''
+def process_questionnaires(directory, audit):
+    return clean_questionnaires(read_questionnaires(directory), audit)
 
-    surveys = surveys[(surveys['height'] > 0) & (surveys['weight'] > 0)]
+def read_questionnaires(directory):
+    with TRACER.stage('Read Questionnaires') as stage:
+        questionnaires_file = os.path.join(directory, 'questionnaires.csv')
+        questionnaires = pd.read_csv(questionnaires_file, usecols = QUESTIONNAIRE_COLUMNS)
+        stage.rows = len(questionnaires.index)
 
-    remaining_subjects = len(surveys.index)
+    return questionnaires
 
-    print('Discarding Subjects with Erroneous Measurements:\nSurvey Subjects: %d -> %d\n' % 
-        (initial_subjects, remaining_subjects))
+def clean_questionnaires(questionnaires, audit):
+    with TRACER.stage('Clean Questionnaires') as stage:
+        questionnaires = questionnaires.drop_duplicates()
+        questionnaires['username'] = questionnaires['username'].str.lower()
+        questionnaires['q3_check_6_answer'].fillna('', inplace = True)
+        questionnaires['q3_check_6_answer'] = questionnaires['q3_check_6_answer'].apply(lambda x: x != '')
+        questionnaires = apply_rules(questionnaires, 'questionnaires', 'username', 
+            [discard_questionnaire_clashes], audit)
+        stage.rows = len(questionnaires.index)
 
-    return surveys
+    return questionnaires
 
-def apply_serving_guidelines(row, serving):
-    return row[serving] - RECOMMENDATIONS[serving][row['gender']]
+'''
+Loads and cleans the meals dataset, and marks its liquids.
+'''
+def process_meals(directory, audit):
+    return clean_meals(read_meals(directory), read_liquids(directory), audit)
 
-def discard_questionnaire_clashes(questionnaires):
-    initial_entries = len(questionnaires.index)
+'''
+Reads meals.xlsx, or meals.csv for cohorts too large to fit in an Excel sheet.
+'''
+def read_meals(directory):
+    with TRACER.stage('Read Meals') as stage:
+        meals_file = os.path.join(directory, 'meals.xlsx')
 
-    clash_check = copy.deepcopy(questionnaires)
-    clash_check = clash_check.groupby(QUESTIONNAIRE_COLUMNS).size().reset_index(name = 'counts')
-    clash_check = clash_check.groupby(['username', 'date']).size().reset_index(name = 'counts')
-    clash_check = clash_check.groupby(['username'], as_index = False).agg({'date': 'count', 'counts': 'max'})
+        if os.path.exists(meals_file):
+            meals = pd.read_excel(meals_file, dtype = {'date': str})
+        else:
+            meals = pd.read_csv(os.path.join(directory, 'meals.csv'), dtype = {'date': str})
 
-    initial_subjects = len(clash_check.index)
+        stage.rows = len(meals.index)
 
-    clash_check = clash_check[clash_check['counts'] == 1]
-    clash_check = clash_check[['username']]
+    return meals
 
-    remaining_subjects = len(clash_check.index)
+def read_liquids(directory):
+    liquids_file = os.path.join(directory, 'liquids.csv')
+    return pd.read_csv(liquids_file, usecols = LIQUID_COLUMNS)
+
+def clean_meals(meals, liquids, audit):
+    with TRACER.stage('Clean Meals') as stage:
+        meals['username'] = meals['username'].str.lower()
+        meals['date'] = meals['date'].apply(lambda time: time.split(' ')[0])
+        meals = mark_for_discard(meals)
+        meals = discard_duplicate_items(meals)
+        stage.rows = len(meals.index)
+
+    with TRACER.stage('Merge Liquids') as stage:
+        # An inner merge would group the items by food, so the unknown foods are dropped first and
+        # the items are kept in the order they were recorded, whichever subjects are processed together
+        meals = meals[meals['foodName'].isin(liquids['foodName'])]
+        meals = meals.merge(liquids, left_on = 'foodName', right_on = 'foodName', how = 'left')
+        meals['drinks'] = np.where(meals['is liquid'], meals['total'], 0)
+        stage.rows = len(meals.index)
 
-    questionnaires = questionnaires.merge(clash_check, left_on = 'username', right_on = 'username', how = 'inner')
+    return meals
 
-    remaining_entries = len(questionnaires.index)
+def discard_unknown_gender(surveys, keep):
+    return surveys['gender'] != 3
 
-    print('Discarding Subjects with Questionaire Clashes:\nQuestionnaire Subjects: %d -> %d\nQuestionnaire Entries: %d -> %d\n' % 
-        (initial_subjects, remaining_subjects, initial_entries, remaining_entries))
+def discard_survey_clashes(surveys, keep):
+    clashes = np.zeros(len(surveys.index), dtype = bool)
+    clashes[keep.values] = surveys.loc[keep, 'email'].duplicated(keep = False).values
 
-    return questionnaires
+    return pd.Series(~clashes, index = surveys.index)
+
+def discard_erroneous_measurements(surveys, keep):
+    return (surveys['height'] > 0) & (surveys['weight'] > 0)
+
+def apply_serving_guidelines(surveys, serving):
+    return surveys[serving] - surveys['gender'].map(RECOMMENDATIONS[serving])
+
+def discard_questionnaire_clashes(questionnaires, keep):
+    # Count the distinct (and complete) responses of each subject on each day
+    complete = keep & questionnaires[QUESTIONNAIRE_COLUMNS].notna().all(axis = 1)
+    distinct = np.zeros(len(questionnaires.index), dtype = bool)
+    distinct[complete.values] = ~questionnaires.loc[complete, QUESTIONNAIRE_COLUMNS].duplicated().values
+    distinct = pd.Series(distinct, index = questionnaires.index)
+
+    counts = distinct.groupby([questionnaires['username'], questionnaires['date']]).transform('sum')
+    counts = counts.groupby(questionnaires['username']).transform('max')
+
+    return counts == 1
 
 def mark_for_discard(meals):
     meals['manual discard'] = meals['foodName'].apply(lambda x: x in MANUAL_DISCARDS)
@@ -223,15 +584,25 @@ def discard_duplicate_items(meals):
 
     return meals
 
-def day_aggregation(combination):
-    groupings = copy.deepcopy(GROUPING_COLUMNS)
-    groupings[0] = 'email'
+def meal_cube(combination):
+    results = copy.deepcopy(AGGREGATION_COLUMNS)
+    results['manual discard'] = 'max'
+
+    cube, names = build_cube(combination, ['email', 'date', 'foodtype'], results)
+
+    print('Building Meal-Level Cube:\nCube Cells: %d\n' % 
+        (len(cube.index)))
 
+    return cube, names
+
+def day_aggregation(cube, days):
     results = copy.deepcopy(AGGREGATION_COLUMNS)
-    results['foodtype'] = pd.Series.nunique
+    results['foodtype'] = 'nunique'
     results['manual discard'] = 'max'
 
-    day_agg = combination.groupby(groupings, as_index = False).agg(results)
+    # The attributes of each day are constant within it, so the roll-up keeps the order of grouping by them
+    day_agg = rollup(cube, ['email', 'date'], results)
+    day_agg = day_agg.merge(days, on = ['email', 'date'], how = 'left')[GROUPING_COLUMNS + list(results)]
 
     daily_entries = len(day_agg.index)
 
@@ -240,23 +611,27 @@ def day_aggregation(combination):
 
     return day_agg
 
-def bmr(row):
-    if row['gender'] == 1:
-        return 64*row['weight'] + 2840
-    else:
-        return 61.5*row['weight'] + 2080
+def bmr(day_agg):
+    return pd.Series(np.where(day_agg['gender'] == 1, 64*day_agg['weight'] + 2840, 61.5*day_agg['weight'] + 2080),
+                     index = day_agg.index)
 
-def meal_aggregation(combination, day_agg, subtype):
-    groupings = copy.deepcopy(GROUPING_COLUMNS)
-    groupings[0] = 'email'
-    groupings.append('foodtype')
+def meal_aggregation(cube, names, days, subtype):
+    keys = ['email', 'date', 'foodtype']
 
     results = copy.deepcopy(AGGREGATION_COLUMNS)
-    results['foodName'] = ';'.join
 
-    meal_agg = combination.groupby(groupings, as_index = False).agg(results)
-    day_agg = day_agg[['email', 'date']]
-    meal_agg = meal_agg.merge(day_agg, left_on = ['email', 'date'], right_on = ['email', 'date'], how = 'inner')
+    # Meals only have one cell of each kind, so their names can be taken from it. Meals
+    # with a missing foodtype are left out of the roll-up
+    if subtype == 'Full':
+        meal_agg = rollup(cube, keys, results)
+        meal_agg = meal_agg.merge(names, on = keys, how = 'left')
+    else:
+        results['foodName'] = 'first'
+        meal_agg = rollup(cube, keys, results, MEAL_KINDS[subtype])
+
+    # Only the days that were kept are joined, along with their attributes
+    meal_agg = meal_agg.merge(days, on = ['email', 'date'], how = 'inner')
+    meal_agg = meal_agg[GROUPING_COLUMNS + ['foodtype'] + list(AGGREGATION_COLUMNS) + ['foodName']]
 
     meal_entries = len(meal_agg.index)
 
@@ -266,7 +641,7 @@ def meal_aggregation(combination, day_agg, subtype):
     return meal_agg
 
 def subject_aggregation(day_agg):
-    groupings = copy.deepcopy(SURVEY_COLUMNS)
+    groupings = copy.deepcopy(SUBJECT_COLUMNS)
 
     results = copy.deepcopy(AGGREGATION_COLUMNS)
     results['date'] = pd.Series.nunique
@@ -280,63 +655,88 @@ def subject_aggregation(day_agg):
 
     return subject_agg
 
-def discard_marked(df):
-    initial_entries = len(df.index)
+'''
+Adds the mean of each aggregation column and the BMR multiplier over the 
+WINDOW_DAYS days up to and including each day. Days a subject did not 
+record are skipped, so the means are over the recorded days of the window.
+'''
+def rolling_aggregation(day_agg):
+    columns = list(AGGREGATION_COLUMNS) + ['bmr multiplier']
 
-    df = df[df['manual discard'] == False]
-    df.drop(columns=['manual discard'], inplace = True)
+    means = ['%s (%d-day mean)' % (c, WINDOW_DAYS) for c in columns]
 
-    remaining_entries = len(df.index)
+    rolling_agg = day_agg.sort_values(['email', 'date'], kind = 'mergesort').reset_index(drop = True)
 
-    print('Discarding Marked Entries:\nDaily Entries: %d -> %d\n' % 
-        (initial_entries, remaining_entries))
+    if rolling_agg.empty:
+        print('Performing Rolling Combination:\nDaily Entries: 0\n')
 
-    return df
+        return rolling_agg.reindex(columns = list(rolling_agg.columns) + means + ['days in window'])
 
-def apply_lower_multiplier_threshold(day_agg):
-    initial_entries = len(day_agg.index)
+    # Subjects are given disjoint ranges of day numbers, so a single sorted array of 
+    # keys can be searched for the start of every window at once
+    subjects = pd.factorize(rolling_agg['email'])[0]
+    days = (pd.to_datetime(rolling_agg['date']) - pd.Timestamp(rolling_agg['date'].min())).dt.days.values
+    keys = subjects.astype(np.int64)*(days.max() + WINDOW_DAYS) + days
 
-    day_agg = day_agg[day_agg['bmr multiplier'] > 0.5]
+    starts = np.searchsorted(keys, keys - (WINDOW_DAYS - 1), side = 'left')
+    counts = np.arange(1, len(keys) + 1) - starts
 
-    remaining_entries = len(day_agg.index)
+    # Missing values are left out of the sums and the counts, so a window with 
+    # no values of a column has a NaN mean rather than spreading the NaN on
+    values = rolling_agg[columns].values.astype(float)
+    present = np.vstack([np.zeros((1, len(columns))), np.cumsum(~np.isnan(values), axis = 0)])
+    sums = np.vstack([np.zeros((1, len(columns))), np.cumsum(np.nan_to_num(values), axis = 0)])
 
-    print('Discarding Entries Below Lower BMR Multiplier Threshold:\nDaily Entries: %d -> %d\n' % 
-        (initial_entries, remaining_entries))
+    present = present[1:] - present[starts]
 
-    return day_agg
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        window = np.where(present > 0, (sums[1:] - sums[starts])/present, np.nan)
 
-def apply_upper_multiplier_threshold(day_agg):
-    initial_entries = len(day_agg.index)
+    for i, c in enumerate(means):
+        rolling_agg[c] = window[:, i]
 
-    day_agg = day_agg[day_agg['bmr multiplier'] < 3.0]
+    rolling_agg['days in window'] = counts
 
-    remaining_entries = len(day_agg.index)
+    print('Performing Rolling Combination:\nDaily Entries: %d\n' % 
+        (len(rolling_agg.index)))
 
-    print('Discarding Entries Above Upper BMR Multiplier Threshold:\nDaily Entries: %d -> %d\n' % 
-        (initial_entries, remaining_entries))
+    return rolling_agg
 
-    return day_agg
+'''
+Summarises the aggregation columns and the BMR multiplier of each subject 
+over each calendar week (starting on Monday).
+'''
+def week_aggregation(day_agg):
+    groupings = copy.deepcopy(SUBJECT_COLUMNS) + ['week']
 
-def discard_insufficient_entries(day_agg):
-    initial_entries = len(day_agg.index)
+    weeks = pd.to_datetime(day_agg['date']).dt.to_period('W').dt.start_time.dt.strftime('%Y-%m-%d')
 
-    days = day_agg.groupby(['email'], as_index = False).agg({'date': 'count'})
+    results = {'days': ('date', 'count')}
 
-    initial_subjects = len(days.index)
+    for c in list(AGGREGATION_COLUMNS) + ['bmr multiplier']:
+        for statistic in ['mean', 'min', 'max']:
+            results['%s (week %s)' % (c, statistic)] = (c, statistic)
 
-    days = days[days['date'] >= 2]
-    days = days[['email']]
+    week_agg = day_agg.assign(week = weeks).groupby(groupings, as_index = False).agg(**results)
 
-    remaining_subjects = len(days.index)
+    print('Performing Week-Level Combination:\nWeekly Entries: %d\n' % 
+        (len(week_agg.index)))
 
-    day_agg = day_agg.merge(days, left_on = 'email', right_on = 'email', how = 'inner')
+    return week_agg
 
-    remaining_entries = len(day_agg.index)
+def discard_marked(df, keep):
+    return df['manual discard'] == False
 
-    print('Discarding Subjects with Insufficient Daily Entries:\nSubjects: %d -> %d\nDaily Entries: %d -> %d\n' % 
-        (initial_subjects, remaining_subjects, initial_entries, remaining_entries))
+def apply_lower_multiplier_threshold(day_agg, keep):
+    return day_agg['bmr multiplier'] > 0.5
 
-    return day_agg
+def apply_upper_multiplier_threshold(day_agg, keep):
+    return day_agg['bmr multiplier'] < 3.0
+
+def discard_insufficient_entries(day_agg, keep):
+    days = keep.groupby(day_agg['email']).transform('sum')
+
+    return days >= 2
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
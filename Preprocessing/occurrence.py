@@ -0,0 +1,53 @@
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+'''
+The food occurrence matrices count how many times each food was recorded
+in each row of an aggregation, e.g. each day or each subject, so that what
+was eaten can be clustered as well as the nutrients it added up to. Foods
+are identified by integer ids, which are their positions in the sorted list
+of food names, and the matrices are stored sparsely, as a row only holds a
+small fraction of the foods.
+'''
+
+'''
+Retrieves the sorted names of the foods of the meal items, whose positions
+are their ids.
+'''
+def food_ids(items):
+    return np.sort(items['foodName'].unique())
+
+'''
+Builds the occurrence matrix of the meal items over the rows of an aggregation.
+
+Parameters
+----------
+items : dataframe
+    The meal items.
+rows : dataframe
+    The columns identifying each row of the aggregation, e.g. email and
+    date, in the order of the aggregation. Items that do not belong to any
+    of the rows are left out.
+foods : array_like
+    The food names, as returned by food_ids.
+
+Returns
+-------
+matrix : sparse matrix
+    The number of items of each food in each row, in CSR format.
+'''
+def occurrence_matrix(items, rows, foods):
+    keys = list(rows.columns)
+    rows = rows.reset_index(drop = True).reset_index()
+
+    # A left merge keeps the order of the items
+    row = items[keys].merge(rows, on = keys, how = 'left')['index'].values
+    food = pd.Index(foods).get_indexer(items['foodName'])
+    found = ~np.isnan(row) & (food >= 0)
+
+    matrix = sparse.coo_matrix((np.ones(found.sum(), dtype = np.int32), (row[found].astype(int), food[found])),
+                               shape = (len(rows.index), len(foods)))
+
+    # Repeated entries of the same row and food are summed
+    return matrix.tocsr()